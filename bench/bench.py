@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gen
+
+STAGES = ('clean', 'parse-gpxpy', 'parse-fast', 'save', 'full')
+# compared against a baseline, lower is better except for the throughput metrics
+METRICS = ('seconds', 'points_per_s', 'mb_per_s', 'peak_rss_mb', 'output_bytes')
+HIGHER_IS_BETTER = ('points_per_s', 'mb_per_s')
+
+def gpx_files(corpus):
+    paths = []
+    for root, _, files in os.walk(corpus, followlinks=True):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith('.gpx'))
+    return sorted(paths)
+
+def corpus_stats(corpus):
+    files = gpx_files(corpus)
+    points = size = 0
+    for path in files:
+        with open(path, 'rb') as f:
+            content = f.read()
+        size += len(content)
+        points += content.count(b'<trkpt')
+    return {"files": len(files), "bytes": size, "points": points}
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def output_size(workdir):
+    size = 0
+    for root, dirs, files in os.walk(workdir):
+        dirs[:] = [d for d in dirs if d not in (gen.GPX_DIR, gen.CACHE_DIR)]
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+def bench_clean(files, workdir, options):
+    start = time.perf_counter()
+    for path in files:
+        with open(path, 'r') as f:
+            gen.clean_gpx_namespaces(f.read())
+    return {"seconds": time.perf_counter() - start}
+
+def bench_parse(files, workdir, options, reader):
+    start = time.perf_counter()
+    for path in files:
+        for _ in gen.parse_gpx(path, gen.Config(reader=reader, simplify=options["simplify"])):
+            pass
+    return {"seconds": time.perf_counter() - start}
+
+def bench_save(files, workdir, options):
+    # parsing is done up front, only the writing is timed
+    config = gen.Config(reader='fast', simplify=options["simplify"], encoding=options["encoding"], output_dir=workdir)
+    items = [item for path in files for item in gen.parse_gpx(path, config)]
+    start = time.perf_counter()
+    totals = gen.save_geodata(iter(items), config)
+    seconds = time.perf_counter() - start
+    # throughput of the written, gzipped data rather than of the GPX input
+    size = output_size(workdir)
+    return {"seconds": seconds, "points": totals["points"], "bytes": size, "output_bytes": size}
+
+def bench_full(files, workdir, options):
+    start = time.perf_counter()
+    gen.main(gen.Config(geodata=True, full=True, jobs=options["jobs"], reader=options["reader"],
+                        simplify=options["simplify"], encoding=options["encoding"], tracks_dir=options["corpus"],
+                        output_dir=workdir, cache_dir=os.path.join(workdir, gen.CACHE_DIR),
+                        deepstate=os.path.join(workdir, gen.DEEPSTATE_GEOJSON)))
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "output_bytes": output_size(workdir)}
+
+STAGE_FUNCTIONS = {
+    'clean': bench_clean,
+    'parse-gpxpy': lambda files, workdir, options: bench_parse(files, workdir, options, 'gpxpy'),
+    'parse-fast': lambda files, workdir, options: bench_parse(files, workdir, options, 'fast'),
+    'save': bench_save,
+    'full': bench_full,
+}
+
+def run_stage(stage, options, queue):
+    # runs in a fresh process, so the peak RSS belongs to this stage alone
+    files = gpx_files(options["corpus"])
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            result = STAGE_FUNCTIONS[stage](files, workdir, options)
+    result["peak_rss_mb"] = peak_rss_mb()
+    queue.put(result)
+
+def measure(stage, options, corpus):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_stage, args=(stage, options, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    result.setdefault("points", corpus["points"])
+    result.setdefault("bytes", corpus["bytes"])
+    result["points_per_s"] = result["points"] / result["seconds"] if result["seconds"] else 0.0
+    result["mb_per_s"] = result["bytes"] / 2**20 / result["seconds"] if result["seconds"] else 0.0
+    return result
+
+def run_benchmarks(options, stages, repeat=1):
+    corpus = corpus_stats(options["corpus"])
+    print(f"[*] Corpus: {corpus['files']} files, {corpus['bytes'] / 2**20:.1f} MB, {corpus['points']} track points")
+    results = {}
+    for stage in stages:
+        runs = [measure(stage, options, corpus) for _ in range(repeat)]
+        # the fastest run is the least disturbed by the rest of the machine
+        results[stage] = min(runs, key=lambda run: run["seconds"])
+        print(f"[+] {stage}: {results[stage]['seconds']:.2f} s")
+    return {"corpus": corpus, "options": {k: v for k, v in options.items() if k != "corpus"}, "stages": results}
+
+def print_report(report):
+    print(f"{'stage':<12} {'seconds':>9} {'points/s':>11} {'MB/s':>8} {'peak MB':>8} {'output KB':>10}")
+    for stage, result in report["stages"].items():
+        output = f"{result['output_bytes'] / 1024:.0f}" if "output_bytes" in result else "-"
+        print(f"{stage:<12} {result['seconds']:>9.2f} {result['points_per_s']:>11.0f} {result['mb_per_s']:>8.1f} "
+              f"{result['peak_rss_mb']:>8.1f} {output:>10}")
+
+def compare_report(report, baseline, threshold):
+    if report["corpus"] != baseline["corpus"]:
+        print("[!] The baseline was measured on a different corpus, the comparison is only indicative")
+    regressions = 0
+    for stage, result in report["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        for metric in METRICS:
+            if metric not in result or not base.get(metric):
+                continue
+            change = result[metric] / base[metric] - 1
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            marker = "[!]" if worse > threshold else "[+]"
+            regressions += worse > threshold
+            print(f"{marker} {stage} {metric}: {base[metric]:.6g} -> {result[metric]:.6g} ({change:+.1%})")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the GPX pipeline on a corpus, see gpx_corpus.py to make one")
+    parser.add_argument('corpus', help='Directory with GPX files')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), help='Stages to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, metavar='N', help='Run every stage N times and keep the fastest run')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help='Worker processes for the full run')
+    parser.add_argument('--reader', choices=gen.READERS, default='gpxpy', help='GPX reader for the full run')
+    parser.add_argument('--simplify', type=float, metavar='METRES', help='Douglas-Peucker tolerance, as for gen.py')
+    parser.add_argument('--encoding', choices=gen.ENCODINGS, default='json', help='Output encoding of the save and full stages')
+    parser.add_argument('--save', metavar='FILE', help='Write the results as JSON, e.g. to use as a baseline later')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare against results saved with --save')
+    parser.add_argument('--threshold', type=float, default=0.15, help='Relative change counted as a regression (default: 0.15)')
+    args = parser.parse_args()
+    options = {"corpus": args.corpus, "jobs": args.jobs or os.cpu_count(), "reader": args.reader,
+               "simplify": args.simplify, "encoding": args.encoding}
+    report = run_benchmarks(options, args.stages, args.repeat)
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"[+] Results saved to {args.save}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_report(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"[!] {regressions} regression(s) over {args.threshold:.0%}")
+            sys.exit(1)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import os
+import sys
+import random
+import argparse
+import tempfile
+from itertools import chain
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gen
+
+# re-checks the R-tree search of `gen.py query` against a scan of every line of every track
+
+def all_lines(tracks):
+    # the same lines as gen.chunk_lines, a single point being a line of length zero
+    a, b, owners = [], [], []
+    for i, track in enumerate(tracks):
+        for segment in track.segments:
+            end = segment[1:] if len(segment) > 1 else segment
+            a.append(segment[:len(end)])
+            b.append(end)
+            owners.append(np.full(len(end), i))
+    if not a:
+        return np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0, dtype=np.int64)
+    return np.concatenate(a), np.concatenate(b), np.concatenate(owners)
+
+def scan_bbox(tracks, waypoints, lines, box):
+    a, b, owners = lines
+    names = sorted(tracks[i].filename for i in np.unique(owners[gen.lines_in_box(a, b, box)]).tolist())
+    points = sorted((p.name, p.filename) for p in waypoints
+                    if box[0] <= p.lat <= box[2] and box[1] <= p.lon <= box[3])
+    return names, points
+
+def scan_nearby(tracks, waypoints, lines, lat, lon, radius):
+    a, b, owners = lines
+    near = owners[gen.line_distances(a, b, lat, lon) <= radius]
+    names = sorted(tracks[i].filename for i in np.unique(near).tolist())
+    coords = np.array([(p.lat, p.lon) for p in waypoints]).reshape(-1, 2)
+    distances = np.hypot(*gen.local_xy(coords, lat, lon).T)
+    points = sorted((p.name, p.filename) for p, d in zip(waypoints, distances.tolist()) if d <= radius)
+    return names, points
+
+def indexed(result):
+    return (sorted(t["filename"] for t in result["tracks"]),
+            sorted((p["name"], p["filename"]) for p in result["waypoints"]))
+
+def check(corpus, queries, seed):
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        config = gen.Config(reader='fast', output_dir=workdir)
+        tracks, waypoints = gen.collect(gen.iter_gpx(gen.iter_gpx_files(corpus), config))
+        gen.save_geodata(chain(tracks, waypoints), config)
+        index = gen.load_spatial_index(workdir)
+    lines = all_lines(tracks)
+    anchors = np.concatenate([lines[0]] + [np.array([(p.lat, p.lon) for p in waypoints]).reshape(-1, 2)])
+    if not len(anchors):
+        print("[!] Nothing to query in this corpus")
+        return 1
+    mismatches = 0
+    for n in range(queries):
+        lat, lon = anchors[rng.randrange(len(anchors))] + np.array([rng.gauss(0, 0.005), rng.gauss(0, 0.005)])
+        if n % 2:
+            radius = rng.uniform(20, 3000)
+            expected = scan_nearby(tracks, waypoints, lines, lat, lon, radius)
+            found = indexed(gen.query_nearby(index, lat, lon, radius))
+            query = f"nearby {lat:.6f} {lon:.6f} --radius {radius:.0f}"
+        else:
+            dlat, dlon = rng.uniform(0.0005, 0.2), rng.uniform(0.0005, 0.2)
+            box = (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+            expected = scan_bbox(tracks, waypoints, lines, box)
+            found = indexed(gen.query_bbox(index, box))
+            query = "bbox " + " ".join(f"{v:.6f}" for v in box)
+        if found != expected:
+            mismatches += 1
+            print(f"[!] {query}: index {len(found[0])} tracks, {len(found[1])} waypoints, "
+                  f"scan {len(expected[0])} tracks, {len(expected[1])} waypoints")
+    print(f"[+] {queries} queries over {len(tracks)} tracks and {len(waypoints)} waypoints: {mismatches} mismatches")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the spatial index against a brute-force scan, see gpx_corpus.py to make a corpus")
+    parser.add_argument('corpus', help='Directory with GPX files')
+    parser.add_argument('--queries', type=int, default=300, metavar='N', help='Random bbox and nearby queries to run (default: 300)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random queries (default: 0)')
+    args = parser.parse_args()
+    sys.exit(check(args.corpus, args.queries, args.seed))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import os
+import math
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+EXTENSIONS = ('none', 'garmin', 'osmand', 'both')
+NAMESPACES = {
+    'garmin': ' xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1"'
+              ' xmlns:gpxx="http://www.garmin.com/xmlschemas/GpxExtensions/v3"',
+    'osmand': ' xmlns:osmand="https://osmand.net"',
+}
+# names include the ':' and '&' that the namespace cleaning has to leave alone
+WAYPOINT_NAMES = ('TODO check ford', 'Spring', 'Viewpoint: ridge', 'Hut & shelter', 'Camp')
+TRACK_STEP_DEG = 0.0002
+
+def point_extensions(extensions, rng, i):
+    parts = []
+    if extensions in ('garmin', 'both'):
+        parts.append('<gpxtpx:TrackPointExtension>'
+                     f'<gpxtpx:hr>{110 + i % 60}</gpxtpx:hr><gpxtpx:cad>{80 + i % 15}</gpxtpx:cad>'
+                     f'<gpxtpx:atemp>{rng.randint(-5, 30)}</gpxtpx:atemp>'
+                     '</gpxtpx:TrackPointExtension>')
+    if extensions in ('osmand', 'both'):
+        parts.append(f'<osmand:speed>{rng.uniform(0.5, 9):.2f}</osmand:speed><osmand:hdop>{rng.uniform(1, 5):.1f}</osmand:hdop>')
+    return f'<extensions>{"".join(parts)}</extensions>' if parts else ''
+
+def write_gpx(path, rng, points, segments, waypoints, extensions):
+    # a random walk from a random start, written point by point so large files stay cheap
+    lat, lon = rng.uniform(44.0, 52.0), rng.uniform(22.0, 40.0)
+    heading = rng.uniform(0, 2 * math.pi)
+    elevation = rng.uniform(100, 1500)
+    time = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(days=rng.randint(0, 365))
+    namespaces = ''.join(NAMESPACES[name] for name in NAMESPACES if extensions in (name, 'both'))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(f'<gpx version="1.1" creator="gpx_corpus" xmlns="http://www.topografix.com/GPX/1/1"{namespaces}>\n')
+        for i in range(waypoints):
+            name = WAYPOINT_NAMES[i % len(WAYPOINT_NAMES)]
+            f.write(f'<wpt lat="{lat + rng.uniform(-0.05, 0.05):.7f}" lon="{lon + rng.uniform(-0.05, 0.05):.7f}">'
+                    f'<name>{name.replace("&", "&amp;")} {i}</name></wpt>\n')
+        f.write('<trk><name>synthetic</name>\n')
+        per_segment = max(1, points // max(segments, 1)) if points else 0
+        written = 0
+        for segment in range(segments if points else 0):
+            f.write('<trkseg>\n')
+            count = per_segment if segment < segments - 1 else points - written
+            for i in range(count):
+                heading += rng.gauss(0, 0.25)
+                lat += math.cos(heading) * TRACK_STEP_DEG
+                lon += math.sin(heading) * TRACK_STEP_DEG * 1.5
+                elevation += rng.gauss(0, 1.5)
+                time += timedelta(seconds=1)
+                f.write(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{elevation:.1f}</ele>'
+                        f'<time>{time.strftime("%Y-%m-%dT%H:%M:%SZ")}</time>'
+                        f'{point_extensions(extensions, rng, written + i)}</trkpt>\n')
+            written += count
+            f.write('</trkseg>\n')
+        f.write('</trk>\n</gpx>\n')
+
+def generate_corpus(output_dir, files=20, points=5000, segments=2, waypoint_density=0.5, extensions='both',
+                    seed=1):
+    # waypoint_density is the average number of waypoints per file, spread unevenly
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(files):
+        # every third file lands in a per-year subdirectory, like a real archive
+        folder = os.path.join(output_dir, f'{2020 + i // 3 % 4}') if i % 3 == 0 else output_dir
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'track_{i:05d}.gpx')
+        waypoints = int(rng.expovariate(1 / waypoint_density)) if waypoint_density > 0 else 0
+        write_gpx(path, rng, points, segments, waypoints, extensions)
+        paths.append(path)
+    return paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic GPX corpus for benchmarks")
+    parser.add_argument('output_dir', help='Directory to write the GPX files to')
+    parser.add_argument('--files', type=int, default=20, help='Number of GPX files (default: 20)')
+    parser.add_argument('--points', type=int, default=5000, help='Track points per file (default: 5000)')
+    parser.add_argument('--segments', type=int, default=2, help='Track segments per file (default: 2)')
+    parser.add_argument('--waypoints', type=float, default=0.5, metavar='N', help='Average waypoints per file (default: 0.5)')
+    parser.add_argument('--extensions', choices=EXTENSIONS, default='both', help='Namespaced Garmin/OsmAnd track point extensions (default: both)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, the same seed gives the same corpus (default: 1)')
+    args = parser.parse_args()
+    paths = generate_corpus(args.output_dir, args.files, args.points, args.segments, args.waypoints, args.extensions, args.seed)
+    size = sum(os.path.getsize(path) for path in paths)
+    print(f"[+] {len(paths)} GPX files, {args.points} points each, {size / 2**20:.1f} MB in {args.output_dir}")
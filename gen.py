@@ -1,70 +1,1975 @@
 #!venv/bin/python
 import os
+import io
 import gpxpy
+import numpy as np
 import re
 import json
 import argparse
 import sys
 import gzip
+import hashlib
+import shutil
+import glob
+import math
+import time
+import tempfile
+import resource
+import tracemalloc
+import asyncio
+import mimetypes
+import threading
+import zipfile
+from array import array
+from datetime import datetime
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, replace
+from functools import partial
+from itertools import chain, islice
+from xml.etree import ElementTree
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote, urlsplit
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 GPX_DIR = 'tracks'
 OUTPUT_HYBRIDMAP_HTML = 'index.html'
+OUTPUT_GEODATA = 'geo_data.json.gz'
+OUTPUT_MANIFEST = 'geo_manifest.json'
+OUTPUT_PROFILE = 'profile.json'
+# the files of the last build, kept along with the current ones, see prune_generation()
+OUTPUT_PUBLISHED = 'published.json'
+TILES_DIR = 'tiles'
+TRACK_DETAILS_DIR = 'track_details'
+SPATIAL_INDEX_DIR = 'spatial_index'
+CACHE_DIR = '.gpxcache'
+# inside the cache directory
+CACHE_INDEX = 'index.json'
+CACHE_VERSION = 6
+DEEPSTATE_GEOJSON = 'deepstate.geojson'
+OUTPUT_DEEPSTATE = 'deepstate.json.gz'
+DEEPSTATE_STAMP = 'deepstate.json'
+DEEPSTATE_VERSION = 1
+# published files carry this many hex digits of their sha256, e.g. geo_data.<hash>.json.gz
+HASH_LENGTH = 16
+HASHED_NAME = re.compile(r'(^|[/.])[0-9a-f]{%d}[/.]' % HASH_LENGTH)
+BROTLI_QUALITY = 11
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8000
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
 
 POINT_SKIP = 5
+GZIP_LEVEL = 9
+# heat points are spooled to disk while tracks are written and read back in chunks of this many
+HEAT_SPOOL_CHUNK = 65536
+ENCODINGS = ('json', 'compact')
+# decimals kept by the compact encoding, 1e-6 degrees is about 11 cm
+COORD_PRECISION = 6
+# zoom bands of the --lod output, the last one uses the parsed geometry as is
+LOD_ZOOM_BANDS = ((0, 7), (8, 10), (11, 13), (14, 18))
+# the --tiles output lists its tiles in tiles/<hash>/TILE_INDEX, fetched by the page before any tile
+TILE_INDEX = 'index.json.gz'
+MAX_MERCATOR_LAT = 85.0511287798
+# --heat-grid bins heat points into HEAT_CELL_PX cells at these zooms, the page
+# uses the finest grid at or below the current zoom
+HEAT_GRID_ZOOMS = (3, 6, 9, 12, 15)
+HEAT_CELL_PX = 4
+HEAT_MERGE_FILES = 16
+# named points are clustered per zoom up to CLUSTER_MAX_ZOOM on a CLUSTER_CELL_PX grid, never
+# across categories; the page draws the points themselves above the last zoom with a cluster
+CLUSTER_MAX_ZOOM = 16
+CLUSTER_CELL_PX = 64
+# marker colour and layer of a named point follow its file name, as on the page
+POINT_ICONS = (('TODO_MAIN', 'green'), ('WP_WAR_RB', 'red'), ('WP_', 'blue'))
+POINT_CATEGORIES = tuple((layer, icon) for layer in ('todo', 'other') for icon in ('green', 'red', 'blue', 'yellow'))
+# the spatial index boxes runs of this many track segments, packed into R-tree nodes of RTREE_NODE_CAPACITY
+INDEX_CHUNK_POINTS = 32
+RTREE_NODE_CAPACITY = 16
+EARTH_RADIUS_M = 6371008.8
+READERS = ('gpxpy', 'fast')
+# the DeepState overlay is quantized to DEEPSTATE_PRECISION decimals (about a metre) and simplified
+# at one pixel of DEEPSTATE_MAX_ZOOM, or of each LOD_ZOOM_BANDS band with --deepstate-lod
+DEEPSTATE_PRECISION = 5
+DEEPSTATE_MAX_ZOOM = 16
+# near-duplicate tracks: cells of DEDUP_CELL_PX pixels at DEDUP_ZOOM (about 76 m at the equator),
+# compared through bottom-k MinHash sketches of the cells a track passes through
+DEDUP_ZOOM = 14
+DEDUP_CELL_PX = 8
+DEDUP_SKETCH = 64
+DEDUP_INDEX_KEYS = 8
+DEDUP_SIMILARITY = 0.8
+# a track is only compared once it spans DEDUP_MIN_CELLS cells (about half a kilometre, a single
+# point covers 9), and only against tracks whose length is within DEDUP_LENGTH_RATIO of its own
+DEDUP_MIN_CELLS = 25
+DEDUP_LENGTH_RATIO = 0.5
+DEDUP_WAYPOINT_M = 25
+# --watch polls tracks/ and rebuilds once nothing changed for WATCH_DEBOUNCE seconds
+WATCH_INTERVAL = 2.0
+WATCH_DEBOUNCE = 5.0
+
+class Stats:
+    # what a run spent its time on, for --profile: seconds per pipeline stage (see timed())
+    # and one record per parsed file
+    def __init__(self):
+        self.stages = {}
+        self.files = []
+        self.stack = []
+
+    def clear(self):
+        self.stages.clear()
+        self.files.clear()
+
+@dataclass
+class Config:
+    # every setting of a build, passed to main(), build() and the pipeline stages;
+    # the command line fills one in from its flags of the same names
+    geodata: bool = False
+    html: bool = False
+    tracks_dir: str = GPX_DIR
+    output_dir: str = '.'
+    # the parse cache and the DeepState stamp, None to always redo the work
+    cache_dir: str = None
+    deepstate: str = DEEPSTATE_GEOJSON
+    full: bool = False
+    jobs: int = 1
+    reader: str = 'gpxpy'
+    simplify: float = None
+    point_skip: int = POINT_SKIP
+    dedup: bool = False
+    lod: bool = False
+    tiles: bool = False
+    encoding: str = 'json'
+    heat_grid: bool = False
+    heat_cap: int = None
+    deepstate_lod: bool = False
+    gzip_level: int = GZIP_LEVEL
+    brotli: bool = False
+    watch: bool = False
+    watch_interval: float = WATCH_INTERVAL
+    profile: bool = False
+    profile_top: int = 10
+    profile_memory: bool = False
+    cprofile: str = None
+    # a Stats to record the timings of build() and save_geodata() in, None to record nothing
+    stats: Stats = None
+
+    @classmethod
+    def from_args(cls, args):
+        config = cls(**{field.name: getattr(args, field.name) for field in fields(cls) if hasattr(args, field.name)})
+        config.jobs = args.jobs or os.cpu_count()
+        config.cache_dir = os.path.join(args.output_dir, CACHE_DIR)
+        return config
+
+# the Stats that timed() adds to, only set inside recording()
+_recording = None
+
+@contextmanager
+def recording(stats):
+    global _recording
+    previous, _recording = _recording, stats
+    try:
+        yield stats
+    finally:
+        _recording = previous
+
+@contextmanager
+def timed(stage):
+    # time in a nested stage is counted there and not in the enclosing one
+    stats = _recording
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    stats.stack.append(0.0)
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stats.stages[stage] = stats.stages.get(stage, 0.0) + elapsed - stats.stack.pop()
+        if stats.stack:
+            stats.stack[-1] += elapsed
+
+class TimedGzipFile(gzip.GzipFile):
+    def write(self, data):
+        with timed('gzip'):
+            return super().write(data)
+
+class ByteCounter(io.RawIOBase):
+    # a file that keeps nothing and only counts the bytes written to it
+    def __init__(self):
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+def open_gzip_text(path, gzip_level=GZIP_LEVEL, fileobj=None):
+    # no timestamp in the header, so the same data always gives the same bytes and content hash
+    return io.TextIOWrapper(TimedGzipFile(path, 'wb', compresslevel=gzip_level, fileobj=fileobj, mtime=0), encoding='utf-8')
 
 def clean_gpx_namespaces(gpx_content):
     cleaned = re.sub(r'\s+xmlns:[^\s=]+="[^"]+"', '', gpx_content)
-    cleaned = re.sub(r'\b\w+?:', '', cleaned)
+    # prefixes are only stripped from element and attribute names, so text such as
+    # timestamps ("10:00:00") and waypoint names ("WP 1: ...") is left intact
+    cleaned = re.sub(r'(</?)[\w.-]+:', r'\1', cleaned)
+    cleaned = re.sub(r'(\s)[\w.-]+:([\w.-]+=)', r'\1\2', cleaned)
     return cleaned
 
-def parse_gpx_file(file_path):
+def douglas_peucker_indices(points, tolerance):
+    n = len(points)
+    if n < 3:
+        return np.arange(n)
+    coords = np.radians(np.asarray(points, dtype=np.float64))
+    # local equirectangular projection, good to well under a metre per km
+    xy = np.empty_like(coords)
+    xy[:, 0] = coords[:, 1] * np.cos(coords[:, 0].mean()) * EARTH_RADIUS_M
+    xy[:, 1] = coords[:, 0] * EARTH_RADIUS_M
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a = xy[first]
+        ab = xy[last] - a
+        ap = xy[first + 1:last] - a
+        ab_len2 = ab @ ab
+        if ab_len2 > 0:
+            t = np.clip(ap @ ab / ab_len2, 0.0, 1.0)
+            ap -= t[:, None] * ab
+        dist2 = np.einsum('ij,ij->i', ap, ap)
+        i = int(dist2.argmax())
+        if dist2[i] > tolerance * tolerance:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+def douglas_peucker(points, tolerance):
+    return np.asarray(points)[douglas_peucker_indices(points, tolerance)]
+
+def thin_indices(points, simplify=None, point_skip=POINT_SKIP):
+    if simplify:
+        return douglas_peucker_indices(points, simplify)
+    return np.arange(0, len(points), max(point_skip, 1))
+
+def cumulative_distances(points):
+    # vectorized haversine, metres from the first point
+    coords = np.radians(np.asarray(points, dtype=np.float64))
+    lat, lon = coords[:, 0], coords[:, 1]
+    a = (np.sin(np.diff(lat) / 2) ** 2 +
+         np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2)
+    steps = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+def elevation_change(elevations):
+    # missing elevations are NaN
+    values = np.asarray(elevations, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    steps = np.diff(values)
+    return steps[steps > 0].sum(), -steps[steps < 0].sum()
+
+def parse_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+def parse_time(text):
+    if not text:
+        return None
+    text = text.strip()
+    # fromisoformat only takes a trailing Z from Python 3.11 on
+    if text[-1:] in ('Z', 'z'):
+        text = text[:-1] + '+00:00'
     try:
-        with open(file_path, 'r') as gpx_file:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    # e.g. fractions of other than 3 or 6 digits before 3.11, parsed the way the gpxpy reader does
+    try:
+        return gpxpy.gpxfield.parse_time(text)
+    except gpxpy.gpx.GPXException:
+        return None
+
+def read_gpx_gpxpy(file_path):
+    with open(file_path, 'r') as gpx_file:
+        with timed('read'):
             gpx_content = gpx_file.read()
+        with timed('clean'):
             gpx_content = clean_gpx_namespaces(gpx_content)
+        with timed('xml'):
             gpx = gpxpy.parse(gpx_content)
-            segments = []
-            all_coords = []
-            for track in gpx.tracks:
-                for segment in track.segments:
-                    points = [(p.latitude, p.longitude) for p in segment.points]
-                    if points:
-                        simplified = points[::POINT_SKIP] if POINT_SKIP > 1 else points
-                        segments.append(simplified)
-                        all_coords.extend(simplified)
-            named_points = []
-            for wpt in gpx.waypoints:
-                if wpt.name:
-                    named_points.append((wpt.latitude, wpt.longitude, wpt.name, os.path.basename(file_path)))
-            return {
-                "filename": os.path.basename(file_path),
-                "coords": all_coords,
-                "segments": segments
-            }, all_coords, named_points
+    with timed('extract'):
+        segments = []
+        elevations = []
+        times = []
+        for track in gpx.tracks:
+            for segment in track.segments:
+                if segment.points:
+                    segments.append(np.array([(p.latitude, p.longitude) for p in segment.points], dtype=np.float64))
+                    elevations.append(np.array([p.elevation for p in segment.points], dtype=np.float64))
+                    times.extend(p.time for p in segment.points if p.time)
+        named_points = []
+        for wpt in gpx.waypoints:
+            if wpt.name:
+                named_points.append((wpt.latitude, wpt.longitude, wpt.name, os.path.basename(file_path)))
+        return segments, elevations, (times[0], times[-1]) if times else (None, None), named_points
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+def read_gpx_fast(file_path):
+    # streams the file and drops every trkpt/wpt once it has been read,
+    # namespaces are resolved by the XML parser instead of being stripped
+    segments = []
+    elevations = []
+    named_points = []
+    first_time = last_time = None
+    filename = os.path.basename(file_path)
+    stack = []
+    points = None
+    for event, elem in ElementTree.iterparse(file_path, events=('start', 'end')):
+        if event == 'start':
+            if not stack and local_name(elem.tag) != 'gpx':
+                raise ValueError(f"unexpected root element <{local_name(elem.tag)}>")
+            stack.append(elem)
+            if local_name(elem.tag) == 'trkseg' and len(stack) == 3:
+                # flat lat, lon pairs, no tuple per point
+                points = array('d')
+                point_elevations = array('d')
+            continue
+        stack.pop()
+        name = local_name(elem.tag)
+        depth = len(stack)
+        if name == 'trkpt' and depth == 3 and points is not None:
+            points.append(float(elem.attrib['lat']))
+            points.append(float(elem.attrib['lon']))
+            elevation = math.nan
+            for child in elem:
+                child_name = local_name(child.tag)
+                if child_name == 'ele':
+                    elevation = parse_float(child.text)
+                    if elevation is None:
+                        elevation = math.nan
+                elif child_name == 'time' and child.text:
+                    last_time = child.text
+                    first_time = first_time or last_time
+            point_elevations.append(elevation)
+        elif name == 'trkseg' and depth == 2:
+            if points:
+                segments.append(np.frombuffer(points, dtype=np.float64).reshape(-1, 2))
+                elevations.append(np.frombuffer(point_elevations, dtype=np.float64))
+            points = None
+        elif name == 'wpt' and depth == 1:
+            wpt_name = next((child.text for child in elem if local_name(child.tag) == 'name'), None)
+            if wpt_name:
+                named_points.append((float(elem.attrib['lat']), float(elem.attrib['lon']), wpt_name, filename))
+        if depth == 1 or (depth == 3 and name == 'trkpt'):
+            stack[-1].remove(elem)
+    return segments, elevations, (parse_time(first_time), parse_time(last_time)), named_points
+
+# a named <wpt>, with the name of the file it came from
+Waypoint = namedtuple('Waypoint', ('lat', 'lon', 'name', 'filename'))
+
+class Track:
+    # one parsed file: segments is a list of (n, 2) float64 arrays of the kept (lat, lon) points,
+    # dist is one int64 array with the cumulative metres at each kept point of all segments;
+    # time_range is the first and last timestamp in epoch seconds, None without times
+    __slots__ = ('filename', 'segments', 'dist', 'stats', 'raw_points', 'time_range')
+
+    def __init__(self, filename, segments, dist, stats, raw_points, time_range=None):
+        self.filename = filename
+        self.segments = segments
+        self.dist = dist
+        self.stats = stats
+        self.raw_points = raw_points
+        self.time_range = time_range
+
+    @property
+    def coords(self):
+        if not self.segments:
+            return np.zeros((0, 2), dtype=np.float64)
+        return np.concatenate(self.segments)
+
+    @property
+    def points(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def to_arrays(self):
+        # for np.savez: the segments as one array cut at their lengths, the rest as a JSON string
+        return {
+            "coords": self.coords,
+            "lengths": np.array([len(segment) for segment in self.segments], dtype=np.int64),
+            "dist": self.dist,
+            "meta": np.array(json.dumps({
+                "filename": self.filename,
+                "stats": self.stats,
+                "raw_points": self.raw_points,
+                "time_range": self.time_range
+            }))
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        meta = json.loads(str(arrays["meta"]))
+        lengths = arrays["lengths"]
+        segments = np.split(arrays["coords"], np.cumsum(lengths)[:-1]) if len(lengths) else []
+        return cls(meta["filename"], segments, arrays["dist"], meta["stats"], meta["raw_points"], meta["time_range"])
+
+def json_default(value):
+    # lets json.dump write the NumPy arrays of a Track
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def read_gpx_file(file_path, reader='gpxpy', simplify=None, point_skip=POINT_SKIP):
+    raw_segments = None
+    if reader == 'fast':
+        try:
+            # reading, parsing and extraction are interleaved in the streaming reader
+            with timed('xml'):
+                raw_segments, elevations, (first_time, last_time), named_points = read_gpx_fast(file_path)
+        except (ElementTree.ParseError, ValueError, KeyError):
+            # e.g. undeclared namespace prefixes, which the gpxpy path strips by regex
+            pass
+    if raw_segments is None:
+        raw_segments, elevations, (first_time, last_time), named_points = read_gpx_gpxpy(file_path)
+    segments = []
+    dist = []
+    length = gain = loss = 0.0
+    for points, point_elevations in zip(raw_segments, elevations):
+        with timed('simplify'):
+            keep = thin_indices(points, simplify, point_skip)
+            segments.append(points[keep])
+        with timed('extract'):
+            # distances are measured on the full track, gaps between segments are not counted
+            cumulative = length + cumulative_distances(points)
+            dist.append(np.round(cumulative[keep]).astype(np.int64))
+            length = cumulative[-1]
+            segment_gain, segment_loss = elevation_change(point_elevations)
+            gain += segment_gain
+            loss += segment_loss
+    try:
+        duration = round((last_time - first_time).total_seconds()) if first_time and last_time else None
+    except TypeError:
+        # naive and timezone-aware timestamps in one file
+        duration = None
+    stats = {
+        "length_m": round(length),
+        "gain_m": round(gain),
+        "loss_m": round(loss),
+        "duration_s": duration
+    }
+    dist = np.concatenate(dist) if dist else np.zeros(0, dtype=np.int64)
+    raw_points = sum(len(points) for points in raw_segments)
+    time_range = (first_time.timestamp(), last_time.timestamp()) if first_time and last_time else None
+    return (Track(os.path.basename(file_path), segments, dist, stats, raw_points, time_range),
+            [Waypoint(*point) for point in named_points])
+
+def parse_gpx(file_path, config=None):
+    # the track of one file followed by its waypoints; parse errors are raised
+    config = config or Config()
+    track, waypoints = read_gpx_file(file_path, config.reader, config.simplify, config.point_skip)
+    yield track
+    yield from waypoints
+
+def parse_gpx_job(file_path, reader='gpxpy', simplify=None, point_skip=POINT_SKIP):
+    # runs in worker processes, errors are returned so the parent reports them in order;
+    # the stage times of this file are recorded apart and returned, the parent adds them
+    # up the same way for every --jobs setting
+    stats = Stats()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # --profile-memory: the peak of this file alone, above what was already allocated
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        with recording(stats):
+            result, error = read_gpx_file(file_path, reader, simplify, point_skip), None
     except Exception as e:
-        print(f"[!] Error parsing {file_path}: {e}")
-        return None, [], []
-
-def save_geodata(tracks, all_points, named_points):
-    print("[*] Saving geodata to geo_data.json...")
-    tracks_data = [t for t in tracks if t is not None]
-    heat_points = all_points
-    named_data = [
-        {"lat": lat, "lon": lon, "name": name, "filename": filename}
-        for lat, lon, name, filename in named_points
-    ]
-    geo_data = {
-        "tracks": tracks_data,
-        "heat_points": heat_points,
-        "named_points": named_data
+        result, error = (None, []), str(e)
+    timing = {
+        "file": file_path,
+        "seconds": time.perf_counter() - start,
+        "bytes": os.path.getsize(file_path),
+        "points": result[0].raw_points if result[0] else 0,
+        "error": error,
+        "stages": stats.stages
+    }
+    if tracing:
+        timing["peak_mb"] = (tracemalloc.get_traced_memory()[1] - held) / 2**20
+    return result, error, timing
+
+def add_file_timing(stats, timing):
+    stats.files.append(timing)
+    for stage, seconds in timing["stages"].items():
+        stats.stages[stage] = stats.stages.get(stage, 0.0) + seconds
+
+def file_hash(file_path, algo='sha1'):
+    # sha1 keys the parse cache, sha256 names the published files
+    h = hashlib.new(algo)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_settings(reader, simplify, point_skip=POINT_SKIP):
+    return {"version": CACHE_VERSION, "point_skip": point_skip, "reader": reader, "simplify": simplify}
+
+def cache_entry_path(file_path, cache_dir=CACHE_DIR):
+    key = hashlib.sha1(file_path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.npz')
+
+def load_parse_cache(settings, cache_dir=CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, CACHE_INDEX), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if index.get("settings") != settings:
+        print("[*] Parse settings changed, cache invalidated")
+        # entries of version 5 and older were gzipped JSON, which a new entry does not overwrite
+        for path in glob.glob(os.path.join(cache_dir, '[0-9a-f]' * 40 + '.json.gz')):
+            os.remove(path)
+        return {}
+    return index.get("files", {})
+
+def save_parse_cache(files, settings, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, CACHE_INDEX)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({"settings": settings, "files": files}, f)
+    os.replace(index_path + '.tmp', index_path)
+
+def read_cache_entry(file_path, cache_dir=CACHE_DIR):
+    # the arrays are stored as they are in memory, so reading an entry costs no per-point parsing
+    try:
+        with timed('cache'), np.load(cache_entry_path(file_path, cache_dir)) as entry:
+            named_points = [Waypoint(*point) for point in json.loads(str(entry["named_points"]))]
+            return Track.from_arrays(entry), named_points
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+def write_cache_entry(file_path, track, named_points, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    with timed('cache'):
+        np.savez(cache_entry_path(file_path, cache_dir), named_points=np.array(json.dumps(named_points)), **track.to_arrays())
+
+def iter_gpx_files(gpx_dir=GPX_DIR):
+    # lazily, in directory walk order; symlinked directories are followed
+    for root, _, files in os.walk(gpx_dir, followlinks=True):
+        for filename in files:
+            if filename.lower().endswith('.gpx'):
+                yield os.path.join(root, filename)
+
+def pool_map(pool, fn, items, window):
+    # like pool.map, but only `window` jobs run ahead of the consumer, so finished
+    # results do not pile up in memory while the caller is still writing earlier ones
+    items = iter(items)
+    pending = deque(pool.submit(fn, item) for item in islice(items, window))
+    while pending:
+        result = pending.popleft().result()
+        for item in islice(items, 1):
+            pending.append(pool.submit(fn, item))
+        yield result
+
+def parse_gpx_files_cached(paths, full=False, jobs=1, reader='gpxpy', simplify=None, point_skip=POINT_SKIP, cache_dir=CACHE_DIR, stats=None):
+    # (track, waypoints) of every file in order; without a cache_dir every file is parsed
+    if full and cache_dir and os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    settings = cache_settings(reader, simplify, point_skip)
+    cached = load_parse_cache(settings, cache_dir) if cache_dir and not full else {}
+    plan = []
+    with timed('discover'):
+        for file_path in paths:
+            st = os.stat(file_path)
+            entry = cached.get(file_path)
+            digest, hit = None, False
+            if entry and entry["size"] == st.st_size:
+                # an unchanged mtime is trusted, otherwise the content decides
+                digest = entry["hash"] if entry["mtime"] == st.st_mtime_ns else file_hash(file_path)
+                hit = digest == entry["hash"]
+            plan.append((file_path, st, digest or (file_hash(file_path) if cache_dir else None), hit))
+    to_parse = [file_path for file_path, _, _, hit in plan if not hit]
+    job = partial(parse_gpx_job, reader=reader, simplify=simplify, point_skip=point_skip)
+    pool = None
+    if jobs > 1 and len(to_parse) > 1:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        parsed_results = pool_map(pool, job, to_parse, jobs * 2)
+    else:
+        parsed_results = map(job, to_parse)
+    files = {}
+    reused = parsed = 0
+    try:
+        for file_path, st, digest, hit in plan:
+            result = read_cache_entry(file_path, cache_dir) if hit else None
+            if result is None:
+                print(f"[*] Processing {file_path}")
+                result, error, timing = next(parsed_results) if not hit else job(file_path)
+                if stats:
+                    add_file_timing(stats, timing)
+                if error is not None:
+                    # not cached, so the parse error is reported on every run
+                    print(f"[!] Error parsing {file_path}: {error}")
+                    continue
+                if cache_dir:
+                    write_cache_entry(file_path, *result, cache_dir)
+                parsed += 1
+            else:
+                reused += 1
+            files[file_path] = {"size": st.st_size, "mtime": st.st_mtime_ns, "hash": digest}
+            yield result
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+    if not cache_dir:
+        print(f"[+] {parsed} files parsed")
+        return
+    removed = 0
+    for file_path in cached:
+        if file_path not in files:
+            try:
+                os.remove(cache_entry_path(file_path, cache_dir))
+            except OSError:
+                pass
+            removed += 1
+    save_parse_cache(files, settings, cache_dir)
+    print(f"[+] Cache: {parsed} parsed, {reused} reused, {removed} removed")
+
+def iter_gpx(paths, config=None):
+    # the tracks and waypoints of many files as one stream, parsed in config.jobs processes and
+    # reused from config.cache_dir when set; files that fail to parse are reported and skipped
+    config = config or Config()
+    for track, waypoints in parse_gpx_files_cached(paths, config.full, config.jobs, config.reader, config.simplify,
+                                                   config.point_skip, config.cache_dir, config.stats):
+        yield track
+        yield from waypoints
+
+def simplify_tracks(items, tolerance):
+    # a further Douglas-Peucker pass over parsed tracks, the distances of the kept points go along
+    for item in items:
+        if isinstance(item, Track) and tolerance:
+            segments, dist, offset = [], [], 0
+            for segment in item.segments:
+                keep = douglas_peucker_indices(segment, tolerance)
+                segments.append(segment[keep])
+                dist.append(item.dist[offset + keep])
+                offset += len(segment)
+            item = Track(item.filename, segments, np.concatenate(dist) if dist else item.dist, item.stats,
+                         item.raw_points, item.time_range)
+        yield item
+
+def filter_tracks(items, predicate):
+    # waypoints pass through, see filter_waypoints
+    return (item for item in items if not isinstance(item, Track) or predicate(item))
+
+def filter_waypoints(items, predicate):
+    return (item for item in items if not isinstance(item, Waypoint) or predicate(item))
+
+def in_bbox(south, west, north, east):
+    # a predicate for both filters: a waypoint inside the box, or a track with a kept point in it
+    def predicate(item):
+        if isinstance(item, Waypoint):
+            return south <= item.lat <= north and west <= item.lon <= east
+        coords = item.coords
+        return bool(np.any((coords[:, 0] >= south) & (coords[:, 0] <= north) &
+                           (coords[:, 1] >= west) & (coords[:, 1] <= east)))
+    return predicate
+
+def dedup_gpx_files(paths):
+    # byte-identical copies are skipped before parsing; a file is only hashed once another
+    # file of the same size shows up
+    kept = {}
+    unhashed = {}
+    skipped = skipped_bytes = 0
+    for path in paths:
+        size = os.path.getsize(path)
+        if size not in kept:
+            kept[size] = {}
+            unhashed[size] = path
+            yield path
+            continue
+        if size in unhashed:
+            first = unhashed.pop(size)
+            kept[size][file_hash(first)] = first
+        digest = file_hash(path)
+        if digest in kept[size]:
+            print(f"[*] {path} is a copy of {kept[size][digest]}, skipped")
+            skipped += 1
+            skipped_bytes += size
+            continue
+        kept[size][digest] = path
+        yield path
+    print(f"[+] Dedup: {skipped} identical files skipped ({skipped_bytes} bytes)")
+
+def track_cells(track, zoom=DEDUP_ZOOM, cell_px=DEDUP_CELL_PX):
+    # the grid cells a track passes through, sampled every half cell along its lines so that
+    # the result does not depend on how densely the track was recorded or simplified; every
+    # cell comes with its neighbours, so a copy recorded a few metres to the side still matches
+    cells = 256 * 2 ** zoom // cell_px
+    offsets = np.arange(-1, 2)
+    keys = []
+    for segment in track.segments:
+        x, y = mercator_pixels(segment, zoom)
+        along = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+        samples = np.append(np.arange(0.0, along[-1], cell_px / 2), along[-1])
+        cx = (np.interp(samples, along, x) // cell_px).astype(np.int64)
+        cy = (np.interp(samples, along, y) // cell_px).astype(np.int64)
+        keys.append(((cx[:, None, None] + offsets[:, None]) * cells + cy[:, None, None] + offsets).ravel())
+    return np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+
+def cell_sketch(cells, size=DEDUP_SKETCH):
+    # bottom-k MinHash: the smallest hashes of the cells stand in for the whole set
+    hashes = np.unique(cells.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+    return hashes[:size]
+
+def sketch_similarity(a, b, size=DEDUP_SKETCH):
+    # estimated Jaccard similarity of the cell sets behind two sketches, exact below size cells
+    union = np.union1d(a, b)[:size]
+    if not len(union):
+        return 0.0
+    return len(np.intersect1d(np.intersect1d(a, b), union, assume_unique=True)) / len(union)
+
+def times_overlap(a, b):
+    # tracks without timestamps are matched on their geometry alone
+    return a is None or b is None or (a[0] <= b[1] and b[0] <= a[1])
+
+def lengths_match(a, b, ratio=DEDUP_LENGTH_RATIO):
+    # a short piece that lies on a longer track is part of it, not a copy
+    return min(a, b) >= ratio * max(a, b)
+
+def dedup_tracks(items, similarity=DEDUP_SIMILARITY):
+    # drops tracks that cover the same cells as an earlier one at the same time, e.g. one
+    # ride exported from two devices; the first copy in the stream is kept. Repeats of a
+    # route on other days do not overlap in time and are kept
+    sketches = []
+    index = {}
+    dropped = dropped_points = 0
+    for item in items:
+        if not isinstance(item, Track) or not item.points:
+            yield item
+            continue
+        with timed('dedup'):
+            cells = track_cells(item)
+        if len(cells) < DEDUP_MIN_CELLS:
+            # too small to tell a copy from a track that merely passes the same spot
+            yield item
+            continue
+        with timed('dedup'):
+            sketch = cell_sketch(cells)
+            length = item.stats["length_m"]
+            candidates = {i for key in sketch[:DEDUP_INDEX_KEYS].tolist() for i in index.get(key, ())}
+            match = None
+            for i in sorted(candidates):
+                filename, time_range, other_length, other = sketches[i]
+                if times_overlap(item.time_range, time_range) and lengths_match(length, other_length):
+                    score = sketch_similarity(sketch, other)
+                    if score >= similarity:
+                        match = filename, score
+                        break
+        if match:
+            print(f"[*] {item.filename} duplicates {match[0]} (similarity {match[1]:.2f}), dropped")
+            dropped += 1
+            dropped_points += item.points
+            continue
+        for key in sketch[:DEDUP_INDEX_KEYS].tolist():
+            index.setdefault(key, []).append(len(sketches))
+        sketches.append((item.filename, item.time_range, length, sketch))
+        yield item
+    print(f"[+] Dedup: {dropped} near-duplicate tracks dropped ({dropped_points} points)")
+
+def waypoint_key(waypoint):
+    # waypoints only repeat each other within the same layer and icon, with the same name
+    return point_category(waypoint.filename), ' '.join(waypoint.name.split()).casefold()
+
+def dedup_waypoints(items, radius=DEDUP_WAYPOINT_M):
+    # a waypoint is dropped when an earlier one of the same name and category lies within
+    # radius metres; kept ones are hashed into a grid of radius-sized rows of latitude
+    step = math.degrees(radius / EARTH_RADIUS_M)
+    grid = {}
+    dropped = 0
+    for item in items:
+        if not isinstance(item, Waypoint):
+            yield item
+            continue
+        key = waypoint_key(item)
+        row, col = math.floor(item.lat / step), math.floor(item.lon / step)
+        # a degree of longitude shrinks with latitude, so more columns are within radius
+        span = math.ceil(1 / max(math.cos(math.radians(item.lat)), 1e-3))
+        scale = math.cos(math.radians(item.lat))
+        if any(math.hypot(lat - item.lat, (lon - item.lon) * scale) <= step
+               for r in range(row - 1, row + 2) for c in range(col - span, col + span + 1)
+               for lat, lon in grid.get((key, r, c), ())):
+            dropped += 1
+            continue
+        grid.setdefault((key, row, col), []).append((item.lat, item.lon))
+        yield item
+    print(f"[+] Dedup: {dropped} duplicate waypoints dropped")
+
+def collect(items):
+    # the in-memory sink: every track and waypoint of the stream in two lists
+    tracks, waypoints = [], []
+    for item in items:
+        (tracks if isinstance(item, Track) else waypoints).append(item)
+    return tracks, waypoints
+
+def write_geojson(items, path, gzip_level=GZIP_LEVEL):
+    # a streamed FeatureCollection: a MultiLineString per track and a Point per waypoint,
+    # gzipped when path ends in .gz
+    tmp_path = path + '.tmp'
+    count = 0
+    with (open_gzip_text(tmp_path, gzip_level) if path.endswith('.gz') else open(tmp_path, 'w', encoding='utf-8')) as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        for item in items:
+            if isinstance(item, Track):
+                geometry = {"type": "MultiLineString",
+                            "coordinates": [np.round(segment[:, ::-1], COORD_PRECISION) for segment in item.segments]}
+                properties = dict(item.stats, filename=item.filename)
+            else:
+                geometry = {"type": "Point", "coordinates": [item.lon, item.lat]}
+                properties = {"name": item.name, "filename": item.filename}
+            if count:
+                f.write(', ')
+            f.write(json.dumps({"type": "Feature", "geometry": geometry, "properties": properties}, default=json_default))
+            count += 1
+        f.write(']}')
+    os.replace(tmp_path, path)
+    print(f"[+] {count} features saved to {path}")
+    return count
+
+def encode_varints(values):
+    # zigzag varints in the printable range of the Google polyline format
+    zigzag = np.where(values < 0, ~(values << 1), values << 1).tolist()
+    out = []
+    for value in zigzag:
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+    return ''.join(out)
+
+def encode_polyline(points):
+    # quantized to COORD_PRECISION decimals and delta encoded
+    if not len(points):
+        return ''
+    quantized = np.round(np.asarray(points, dtype=np.float64) * 10 ** COORD_PRECISION).astype(np.int64)
+    return encode_varints(np.diff(quantized, axis=0, prepend=0).ravel())
+
+def dist_steps(dist):
+    # cumulative metres are written as the steps between consecutive points
+    return np.diff(np.asarray(dist, dtype=np.int64), prepend=0)
+
+def encode_track(track, encoding):
+    if encoding == 'json':
+        return track
+    track = dict(track)
+    if "segments" in track:
+        track["segments"] = [encode_polyline(segment) for segment in track["segments"]]
+    if "coords" in track:
+        track["coords"] = encode_polyline(track["coords"])
+    if "dist" in track:
+        track["dist"] = encode_varints(np.asarray(track["dist"], dtype=np.int64))
+    return track
+
+def encode_heat_level(level, encoding):
+    if encoding == 'json':
+        return level
+    return {"zoom": level["zoom"],
+            "cells": encode_polyline([(lat, lon) for lat, lon, _ in level["cells"]]),
+            "weights": [weight for _, _, weight in level["cells"]]}
+
+def encode_geodata(data, encoding):
+    if encoding == 'json':
+        return data
+    data = dict(data, encoding=f"polyline{COORD_PRECISION}")
+    if "tracks" in data:
+        data["tracks"] = [encode_track(t, encoding) for t in data["tracks"]]
+    if "heat_points" in data:
+        data["heat_points"] = encode_polyline(data["heat_points"])
+    if "heat_grid" in data:
+        data["heat_grid"] = [encode_heat_level(level, encoding) for level in data["heat_grid"]]
+    return data
+
+def write_geodata(path, data, encoding='json', gzip_level=GZIP_LEVEL):
+    with timed('serialize'), open_gzip_text(path, gzip_level) as gz:
+        json.dump(encode_geodata(data, encoding), gz, default=json_default)
+
+def open_geodata_stream(path, encoding='json', gzip_level=GZIP_LEVEL):
+    # written next to the final path and moved into place by close_geodata_stream,
+    # so a reader never sees a half-written file
+    gz = open_gzip_text(path + '.tmp', gzip_level)
+    gz.write('{')
+    if encoding != 'json':
+        gz.write(f'"encoding": "polyline{COORD_PRECISION}", ')
+    return gz
+
+def close_geodata_stream(gz, path):
+    gz.write('}')
+    gz.close()
+    os.replace(path + '.tmp', path)
+
+def write_json_items(gz, items):
+    for i, item in enumerate(items):
+        if i:
+            gz.write(', ')
+        gz.write(json.dumps(item, default=json_default))
+
+def lod_tolerance(zoom):
+    # ground size of one 256 px tile pixel at the equator
+    return 2 * np.pi * EARTH_RADIUS_M / 256 / 2 ** zoom
+
+def lod_levels():
+    for level, (min_zoom, max_zoom) in enumerate(LOD_ZOOM_BANDS):
+        tolerance = lod_tolerance(max_zoom) if level < len(LOD_ZOOM_BANDS) - 1 else None
+        yield level, min_zoom, max_zoom, tolerance
+
+def simplify_segments(segments, tolerance):
+    if not tolerance:
+        return segments
+    return [douglas_peucker(segment, tolerance) for segment in segments]
+
+def lod_filename(level):
+    return OUTPUT_GEODATA.replace('.json.gz', f'.lod{level}.json.gz')
+
+def write_json_file(path, data):
+    # written next to the final path and moved into place, like the .json.gz streams
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+def replace_dir(tmp_path, path):
+    # the old directory is served until the new one is renamed into its place
+    old_path = path + '.old'
+    if os.path.isdir(old_path):
+        shutil.rmtree(old_path)
+    if os.path.isdir(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.isdir(old_path):
+        shutil.rmtree(old_path)
+
+def hashed_filename(path, digest):
+    # geo_data.json.gz -> geo_data.<digest>.json.gz
+    return path[:-len('.json.gz')] + f'.{digest[:HASH_LENGTH]}.json.gz'
+
+def hashed_files(path):
+    # the hashed copies of path and their .json.br variants
+    return glob.glob(path[:-len('.json.gz')] + '.' + '[0-9a-f]' * HASH_LENGTH + '.json.*')
+
+def publish_file(name, output_dir='.'):
+    # the page refers to a copy named after the content, so an unchanged file keeps its URL
+    # from build to build and a changed one can never be served from a stale cache;
+    # the returned URL is relative to output_dir like name
+    path = os.path.join(output_dir, name)
+    target = hashed_filename(path, file_hash(path, 'sha256'))
+    if not os.path.exists(target):
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copyfile(path, target)
+    return name[:-len(os.path.basename(name))] + os.path.basename(target)
+
+def prune_generation(kind, current, candidates, output_dir='.'):
+    # a page loaded before this build still fetches the files of the last one, so those are
+    # kept until the next build and only older ones are removed; names are relative to
+    # output_dir, and a .json.br variant goes with its .json.gz
+    record_path = os.path.join(output_dir, OUTPUT_PUBLISHED)
+    try:
+        with open(record_path, 'r') as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        record = {}
+    keep = set(current) | set(record.get(kind, []))
+    for name in candidates:
+        if (name[:-len('br')] + 'gz' if name.endswith('.json.br') else name) in keep:
+            continue
+        path = os.path.join(output_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    record[kind] = sorted(current)
+    write_json_file(record_path, record)
+
+def directory_sha256(path):
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            digest.update(os.path.relpath(file_path, path).encode('utf-8') + b'\0')
+            digest.update(file_hash(file_path, 'sha256').encode('ascii'))
+    return digest.hexdigest()
+
+def same_tile_variant(path, tiles_path):
+    # the .json.br of the same tile in another generation of tiles/, when its .json.gz is identical
+    generation, rel_path = os.path.relpath(path, tiles_path).split(os.sep, 1)
+    with open(path, 'rb') as f:
+        data = f.read()
+    for other in os.listdir(tiles_path):
+        other_path = os.path.join(tiles_path, other, rel_path)
+        if other == generation or not os.path.exists(other_path[:-len('gz')] + 'br'):
+            continue
+        with open(other_path, 'rb') as f:
+            if f.read() == data:
+                return other_path[:-len('gz')] + 'br'
+    return None
+
+def write_brotli_variants(output_dir='.'):
+    # a .json.br beside every published .json.gz; the names are content hashed, so an existing
+    # variant is always current. A new tile generation shares most tiles with the last one,
+    # their variants are linked from there
+    tiles_path = os.path.join(output_dir, TILES_DIR)
+    paths = glob.glob(os.path.join(output_dir, '*.' + '[0-9a-f]' * HASH_LENGTH + '.json.gz'))
+    paths += glob.glob(os.path.join(output_dir, TRACK_DETAILS_DIR, '*.json.gz'))
+    tile_paths = glob.glob(os.path.join(tiles_path, '**', '*.json.gz'), recursive=True)
+    written = reused = 0
+    for path in paths + tile_paths:
+        br_path = path[:-len('gz')] + 'br'
+        if os.path.exists(br_path):
+            continue
+        same_path = same_tile_variant(path, tiles_path) if path.startswith(tiles_path + os.sep) else None
+        if same_path:
+            try:
+                os.link(same_path, br_path)
+            except OSError:
+                shutil.copyfile(same_path, br_path)
+            reused += 1
+            continue
+        with open(path, 'rb') as f:
+            data = brotli.compress(gzip.decompress(f.read()), quality=BROTLI_QUALITY)
+        with open(br_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(br_path + '.tmp', br_path)
+        written += 1
+    print(f"[+] Brotli variants: {written} written, {reused} reused from the last tiles, "
+          f"{len(paths) + len(tile_paths) - written - reused} already there")
+
+def manifest_has_tiles(output_dir='.'):
+    manifest_path = os.path.join(output_dir, OUTPUT_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path, 'r') as f:
+        return "tiles" in json.load(f)
+
+def remove_layout_files(lod=False, tiles=False, had_tiles=False, output_dir='.'):
+    # runs once the new files are in place and drops what only the previous layout wrote
+    if not lod:
+        lod_pattern = os.path.join(output_dir, lod_filename('*'))
+        for path in glob.glob(lod_pattern) + glob.glob(lod_pattern[:-len('gz')] + 'br'):
+            os.remove(path)
+    manifest_path = os.path.join(output_dir, OUTPUT_MANIFEST)
+    if not (lod or tiles) and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    # only a tile pyramid written by this script is removed
+    tiles_path = os.path.join(output_dir, TILES_DIR)
+    if had_tiles and not tiles and os.path.isdir(tiles_path):
+        shutil.rmtree(tiles_path)
+
+def open_lod_levels(encoding='json', gzip_level=GZIP_LEVEL, output_dir='.'):
+    levels = []
+    for level, min_zoom, max_zoom, tolerance in lod_levels():
+        path = os.path.join(output_dir, lod_filename(level))
+        gz = open_geodata_stream(path, encoding, gzip_level)
+        gz.write('"tracks": [')
+        levels.append({"minZoom": min_zoom, "maxZoom": max_zoom, "tolerance": tolerance, "url": lod_filename(level),
+                       "path": path, "gz": gz, "tracks": 0, "points": 0})
+    return levels
+
+def add_lod_track(levels, track, detail, encoding='json'):
+    for level in levels:
+        segments = simplify_segments(track.segments, level["tolerance"])
+        if level["tracks"]:
+            level["gz"].write(', ')
+        level["gz"].write(json.dumps(encode_track(
+            {"filename": track.filename, "detail": detail, "segments": segments}, encoding), default=json_default))
+        level["tracks"] += 1
+        level["points"] += sum(len(segment) for segment in segments)
+
+def close_lod_levels(levels, output_dir='.'):
+    manifest_levels = []
+    for i, level in enumerate(levels):
+        level["gz"].write(']')
+        close_geodata_stream(level["gz"], level["path"])
+        print(f"[+] LOD {i} (zoom {level['minZoom']}-{level['maxZoom']}): {level['points']} points -> {level['path']}")
+        manifest_levels.append({key: level[key] for key in ("minZoom", "maxZoom", "tolerance", "url")})
+    write_json_file(os.path.join(output_dir, OUTPUT_MANIFEST), {"lod": manifest_levels})
+
+def tile_xy(lat, lon, zoom):
+    # fractional web mercator tile coordinates
+    n = 2 ** zoom
+    lat = math.radians(max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat)))
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0 * n
+    return x, y
+
+def tile_latlon(x, y, zoom):
+    n = 2 ** zoom
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * y / n))))
+    return lat, x / n * 360.0 - 180.0
+
+def tile_of(x, y, zoom):
+    n = 2 ** zoom
+    return min(n - 1, max(0, int(math.floor(x)))), min(n - 1, max(0, int(math.floor(y))))
+
+def clip_to_tiles(points, zoom):
+    # splits a polyline into per-tile pieces, adding a shared vertex where it crosses a tile edge
+    pieces = {}
+    if len(points) == 1:
+        pieces[tile_of(*tile_xy(*points[0], zoom), zoom)] = [list(points)]
+        return pieces
+    prev = tile_xy(*points[0], zoom)
+    tile = tile_of(*prev, zoom)
+    piece = [points[0]]
+    for point in points[1:]:
+        cur = tile_xy(*point, zoom)
+        dx, dy = cur[0] - prev[0], cur[1] - prev[1]
+        crossings = []
+        for axis, delta in ((0, dx), (1, dy)):
+            lo, hi = sorted((prev[axis], cur[axis]))
+            for edge in range(int(math.floor(lo)) + 1, int(math.ceil(hi))):
+                crossings.append((edge - prev[axis]) / delta)
+        crossings.sort()
+        for i, t in enumerate(crossings):
+            boundary = tile_latlon(prev[0] + t * dx, prev[1] + t * dy, zoom)
+            piece.append(boundary)
+            pieces.setdefault(tile, []).append(piece)
+            t_next = crossings[i + 1] if i + 1 < len(crossings) else 1.0
+            tile = tile_of(prev[0] + (t + t_next) / 2 * dx, prev[1] + (t + t_next) / 2 * dy, zoom)
+            piece = [boundary]
+        piece.append(point)
+        prev = cur
+    pieces.setdefault(tile, []).append(piece)
+    return pieces
+
+def write_tile(tiles_dir, layer, zoom, x, y, data, encoding='json', gzip_level=GZIP_LEVEL):
+    path = os.path.join(tiles_dir, layer, str(zoom), str(x), f'{y}.json.gz')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_geodata(path, data, encoding, gzip_level)
+
+def add_track_tiles(track_tiles, track, detail):
+    # only the clipped pieces are kept, the track itself is released by the caller
+    for level, min_zoom, _, tolerance in lod_levels():
+        tiles = track_tiles[level]
+        for segment in simplify_segments(track.segments, tolerance):
+            for tile, pieces in clip_to_tiles(segment.tolist(), min_zoom).items():
+                tile_tracks = tiles.setdefault(tile, {})
+                tile_track = tile_tracks.setdefault(detail, {
+                    "filename": track.filename, "detail": detail, "segments": []
+                })
+                tile_track["segments"].extend(pieces)
+
+def band_levels(zooms, min_zoom, max_zoom):
+    # the levels of a per-zoom list the page may pick within a zoom band: those inside it and
+    # the finest one below, which it falls back to (or the coarsest, when none is below)
+    below = [i for i, zoom in enumerate(zooms) if zoom <= min_zoom]
+    first = below[-1] if below else 0
+    return [i for i, zoom in enumerate(zooms) if i == first or min_zoom < zoom <= max_zoom]
+
+def cut_point_tiles(heat_chunks, named_points, heat_grid, clusters, zoom, grid_levels, cluster_levels):
+    point_tiles = {}
+    # tile and index within the tile of every named point, for the single points of the clusters
+    point_slots = []
+    def point_tile(lat, lon):
+        tile = tile_of(*tile_xy(lat, lon, zoom), zoom)
+        if tile not in point_tiles:
+            point_tiles[tile] = {"named_points": []}
+            if heat_grid is None:
+                point_tiles[tile]["heat_points"] = []
+            else:
+                point_tiles[tile]["heat_grid"] = [{"zoom": heat_grid[i]["zoom"], "cells": []} for i in grid_levels]
+            if cluster_levels:
+                point_tiles[tile]["point_clusters"] = [{"zoom": clusters[i]["zoom"], "clusters": [], "points": []} for i in cluster_levels]
+        return point_tiles[tile]
+    if heat_grid is None:
+        for chunk in heat_chunks:
+            for lat, lon in chunk.tolist():
+                point_tile(lat, lon)["heat_points"].append((lat, lon))
+    else:
+        for j, i in enumerate(grid_levels):
+            for cell in heat_grid[i]["cells"]:
+                point_tile(cell[0], cell[1])["heat_grid"][j]["cells"].append(cell)
+    for point in named_points:
+        tile = point_tile(point["lat"], point["lon"])
+        point_slots.append((tile, len(tile["named_points"])))
+        tile["named_points"].append(point)
+    for j, i in enumerate(cluster_levels):
+        for cluster in clusters[i]["clusters"]:
+            point_tile(cluster[0], cluster[1])["point_clusters"][j]["clusters"].append(cluster)
+        for point in clusters[i]["points"]:
+            tile, slot = point_slots[point]
+            tile["point_clusters"][j]["points"].append(slot)
+    return point_tiles
+
+def save_tiles(track_tiles, read_heat, named_points, encoding='json', heat_grid=None, gzip_level=GZIP_LEVEL, clusters=(), output_dir='.'):
+    # heat and named points are cut per zoom band like the tracks, at its first zoom, each band
+    # only with the heat grid and cluster levels its zooms use; read_heat() yields the heat
+    # point chunks again for every band
+    named_points = list(named_points)
+    # written to tiles.tmp/build and moved to tiles/<content hash>/ when complete, next to the
+    # pyramid of the last build
+    tmp_dir = os.path.join(output_dir, TILES_DIR + '.tmp')
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    tiles_dir = os.path.join(tmp_dir, 'build')
+    track_levels, point_levels = [], []
+    index = {"tracks": [], "points": []}
+    for level, min_zoom, max_zoom, _ in lod_levels():
+        for (x, y), tile_tracks in track_tiles[level].items():
+            write_tile(tiles_dir, 'tracks', min_zoom, x, y, {"tracks": list(tile_tracks.values())}, encoding, gzip_level)
+        print(f"[+] Track tiles for zoom {min_zoom}-{max_zoom}: {len(track_tiles[level])} at z{min_zoom}")
+        track_levels.append({"minZoom": min_zoom, "maxZoom": max_zoom, "z": min_zoom})
+        index["tracks"].append([f"{x}/{y}" for x, y in sorted(track_tiles[level])])
+        grid_levels = band_levels([grid["zoom"] for grid in heat_grid], min_zoom, max_zoom) if heat_grid is not None else []
+        # above the last cluster level the page shows the points themselves
+        cluster_levels = [i for i, level in enumerate(clusters) if min_zoom <= level["zoom"] <= max_zoom]
+        point_tiles = cut_point_tiles(read_heat() if heat_grid is None else (), named_points, heat_grid, clusters,
+                                      min_zoom, grid_levels, cluster_levels)
+        for (x, y), data in point_tiles.items():
+            write_tile(tiles_dir, 'points', min_zoom, x, y, data, encoding, gzip_level)
+        print(f"[+] Point tiles for zoom {min_zoom}-{max_zoom}: {len(point_tiles)} at z{min_zoom}")
+        point_levels.append({"minZoom": min_zoom, "maxZoom": max_zoom, "z": min_zoom})
+        index["points"].append([f"{x}/{y}" for x, y in sorted(point_tiles)])
+    # the tile lists follow from the tiles, so they are left out of the hash
+    digest = directory_sha256(tiles_dir)[:HASH_LENGTH]
+    write_geodata(os.path.join(tiles_dir, TILE_INDEX), index, 'json', gzip_level)
+    tiles_path = os.path.join(output_dir, TILES_DIR)
+    # an unchanged pyramid is already in place, with its brotli variants
+    if not os.path.isdir(os.path.join(tiles_path, digest)):
+        os.makedirs(tiles_path, exist_ok=True)
+        os.rename(tiles_dir, os.path.join(tiles_path, digest))
+    shutil.rmtree(tmp_dir)
+    prune_generation('tiles', [f"{TILES_DIR}/{digest}"],
+                     [f"{TILES_DIR}/{name}" for name in os.listdir(tiles_path)], output_dir)
+    # only the levels, small enough to be inlined in the page; the tile lists are in TILE_INDEX
+    write_json_file(os.path.join(output_dir, OUTPUT_MANIFEST), {"tiles": {
+        "url": f"{TILES_DIR}/{digest}",
+        "index": TILE_INDEX,
+        "tracks": track_levels,
+        "points": point_levels
+    }})
+
+def mercator_pixels(coords, zoom):
+    # vectorized web mercator pixel coordinates of a (lat, lon) array
+    size = 256 * 2 ** zoom
+    lat = np.radians(np.clip(coords[:, 0], -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+    x = (coords[:, 1] + 180.0) / 360.0 * size
+    y = (1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * size
+    return x, y
+
+def heat_cell_keys(coords, zoom):
+    x, y = mercator_pixels(coords, zoom)
+    cells = 256 * 2 ** zoom // HEAT_CELL_PX
+    cx = np.clip((x // HEAT_CELL_PX).astype(np.int64), 0, cells - 1)
+    cy = np.clip((y // HEAT_CELL_PX).astype(np.int64), 0, cells - 1)
+    return cx * cells + cy
+
+def mercator_latlon(x, y):
+    # inverse of mercator_pixels for coordinates scaled to the unit square
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * y))))
+    return np.round(lat, COORD_PRECISION), np.round(x * 360.0 - 180.0, COORD_PRECISION)
+
+def heat_cell_centers(keys, zoom):
+    cells = 256 * 2 ** zoom // HEAT_CELL_PX
+    size = 256 * 2 ** zoom
+    x = ((keys // cells) + 0.5) * HEAT_CELL_PX / size
+    y = ((keys % cells) + 0.5) * HEAT_CELL_PX / size
+    return mercator_latlon(x, y)
+
+def add_heat_cells(heat_cells, coords, cap=None):
+    # per grid zoom, points are counted per HEAT_CELL_PX cell; with a cap, a single
+    # file adds at most `cap` to any one cell
+    if not len(coords):
+        return
+    for zoom in HEAT_GRID_ZOOMS:
+        file_keys, file_counts = np.unique(heat_cell_keys(coords, zoom), return_counts=True)
+        if cap:
+            np.minimum(file_counts, cap, out=file_counts)
+        keys, counts = heat_cells[zoom]
+        keys.append(file_keys)
+        counts.append(file_counts)
+        # folded every few files, so the grid grows with the covered area and not the file count
+        if len(keys) >= HEAT_MERGE_FILES:
+            merged_keys, merged_counts = merge_heat_cells(keys, counts)
+            keys[:] = [merged_keys]
+            counts[:] = [merged_counts]
+
+def merge_heat_cells(keys, counts):
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    cell_keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    return cell_keys, np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+
+def build_heat_grid(heat_cells):
+    # one level at a time, a fine level can hold about as many cells as there are points
+    for zoom in HEAT_GRID_ZOOMS:
+        with timed('heat_grid'):
+            cell_keys, weights = merge_heat_cells(*heat_cells[zoom])
+            lats, lons = heat_cell_centers(cell_keys, zoom)
+        print(f"[+] Heat grid z{zoom}: {len(cell_keys)} cells, total weight {int(weights.sum())}")
+        yield zoom, np.column_stack((lats, lons)), weights
+
+def heat_grid_cells(cells, weights):
+    return list(zip(cells[:, 0].tolist(), cells[:, 1].tolist(), weights.tolist()))
+
+def point_category(filename):
+    layer = 'todo' if 'TODO' in filename else 'other'
+    icon = next((icon for marker, icon in POINT_ICONS if marker in filename), 'yellow')
+    return POINT_CATEGORIES.index((layer, icon))
+
+def build_point_clusters(named_points):
+    # supercluster-style: each zoom merges the clusters of the zoom above that share a
+    # category and a CLUSTER_CELL_PX cell, at the count weighted mean of their positions.
+    # A level lists its clusters as [lat, lon, count, category] and its single points
+    # by their index in named_points
+    lats, lons, categories = array('d'), array('d'), array('q')
+    for point in named_points:
+        lats.append(point["lat"])
+        lons.append(point["lon"])
+        categories.append(point_category(point["filename"]))
+    if not len(lats):
+        return []
+    x, y = mercator_pixels(np.column_stack((np.frombuffer(lats), np.frombuffer(lons))), 0)
+    x, y = x / 256, y / 256
+    category = np.frombuffer(categories, dtype=np.int64)
+    count = np.ones(len(x), dtype=np.int64)
+    point = np.arange(len(x))
+    levels = []
+    for zoom in range(CLUSTER_MAX_ZOOM, -1, -1):
+        cells = 256 * 2 ** zoom // CLUSTER_CELL_PX
+        cx = np.clip((x * cells).astype(np.int64), 0, cells - 1)
+        cy = np.clip((y * cells).astype(np.int64), 0, cells - 1)
+        _, inverse = np.unique((category * cells + cx) * cells + cy, return_inverse=True)
+        merged = np.bincount(inverse, weights=count)
+        x = np.bincount(inverse, weights=x * count) / merged
+        y = np.bincount(inverse, weights=y * count) / merged
+        merged_category = np.empty(len(merged), dtype=np.int64)
+        merged_category[inverse] = category
+        merged_point = np.empty(len(merged), dtype=np.int64)
+        merged_point[inverse] = point
+        count, category, point = merged.astype(np.int64), merged_category, merged_point
+        point[count > 1] = -1
+        levels.append((zoom, x, y, count, category, point))
+    # above the last zoom that merges anything the page shows the points as they are
+    levels = [level for level in levels if level[3].max() > 1]
+    clusters = []
+    for zoom, x, y, count, category, point in reversed(levels):
+        multi = count > 1
+        lats, lons = mercator_latlon(x[multi], y[multi])
+        clusters.append({
+            "zoom": zoom,
+            "clusters": list(zip(lats.tolist(), lons.tolist(), count[multi].tolist(), category[multi].tolist())),
+            "points": point[~multi].tolist()
+        })
+    print(f"[+] Waypoint clusters: {len(clusters)} zoom levels, {sum(len(c['clusters']) for c in clusters)} clusters")
+    return clusters
+
+def track_bbox(coords):
+    if not len(coords):
+        return None
+    return coords.min(axis=0).tolist() + coords.max(axis=0).tolist()
+
+def segment_chunks(segment):
+    # runs of INDEX_CHUNK_POINTS lines, neighbouring runs share their end point
+    starts = np.arange(0, max(len(segment) - 1, 1), INDEX_CHUNK_POINTS)
+    ends = np.append(starts[1:], len(segment) - 1)
+    lo = np.minimum.reduceat(segment, starts, axis=0)
+    hi = np.maximum.reduceat(segment, starts, axis=0)
+    lo[:-1] = np.minimum(lo[:-1], segment[starts[1:]])
+    hi[:-1] = np.maximum(hi[:-1], segment[starts[1:]])
+    return starts, ends - starts + 1, np.hstack((lo, hi))
+
+def str_pack(boxes, capacity=RTREE_NODE_CAPACITY):
+    # Sort-Tile-Recursive bulk load of [min_lat, min_lon, max_lat, max_lon] boxes: the leaf
+    # order, and the node boxes of every level from the leaves up, node j of a level
+    # covering entries j * capacity ... (j + 1) * capacity - 1 of the level below
+    if not len(boxes):
+        return np.zeros(0, dtype=np.int64), [np.zeros((0, 4))]
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+    slice_size = math.ceil(math.sqrt(math.ceil(len(boxes) / capacity))) * capacity
+    order = np.argsort(centers[:, 1], kind='stable')
+    for start in range(0, len(order), slice_size):
+        part = order[start:start + slice_size]
+        order[start:start + slice_size] = part[np.argsort(centers[part, 0], kind='stable')]
+    levels = [boxes[order]]
+    while len(levels[-1]) > 1:
+        groups = np.arange(0, len(levels[-1]), capacity)
+        levels.append(np.hstack((np.minimum.reduceat(levels[-1][:, :2], groups),
+                                 np.maximum.reduceat(levels[-1][:, 2:], groups))))
+    return order, levels
+
+def rtree_search(levels, box, capacity=RTREE_NODE_CAPACITY):
+    # leaf positions whose boxes intersect box, walking the packed levels top down
+    candidates = np.arange(len(levels[-1]))
+    for depth in range(len(levels) - 1, -1, -1):
+        nodes = levels[depth][candidates]
+        candidates = candidates[(nodes[:, 0] <= box[2]) & (nodes[:, 2] >= box[0]) &
+                                (nodes[:, 1] <= box[3]) & (nodes[:, 3] >= box[1])]
+        if depth:
+            candidates = (candidates[:, None] * capacity + np.arange(capacity)).ravel()
+            candidates = candidates[candidates < len(levels[depth - 1])]
+    return candidates
+
+def open_spatial_index(output_dir='.'):
+    index_path = os.path.join(output_dir, SPATIAL_INDEX_DIR)
+    index_dir = index_path + '.tmp'
+    if os.path.isdir(index_dir):
+        shutil.rmtree(index_dir)
+    os.makedirs(index_dir)
+    return {"path": index_path, "dir": index_dir, "points": open(os.path.join(index_dir, 'points.f8'), 'wb'), "count": 0,
+            "boxes": array('d'), "track": array('q'), "start": array('q'), "size": array('q'),
+            "filenames": [], "details": []}
+
+def add_index_track(index, track, detail):
+    # the kept points go to disk as they come, only the run boxes stay in memory
+    track_id = len(index["filenames"])
+    index["filenames"].append(track.filename)
+    index["details"].append(detail)
+    for segment in track.segments:
+        starts, sizes, boxes = segment_chunks(segment)
+        index["boxes"].extend(boxes.ravel().tolist())
+        index["track"].extend([track_id] * len(starts))
+        index["start"].extend((starts + index["count"]).tolist())
+        index["size"].extend(sizes.tolist())
+        index["points"].write(segment.tobytes())
+        index["count"] += len(segment)
+
+def close_spatial_index(index, named_points):
+    index["points"].close()
+    order, levels = str_pack(np.frombuffer(index["boxes"], dtype=np.float64).reshape(-1, 4))
+    data = {f"level{i}": level for i, level in enumerate(levels)}
+    data.update(
+        track=np.frombuffer(index["track"], dtype=np.int64)[order],
+        start=np.frombuffer(index["start"], dtype=np.int64)[order],
+        size=np.frombuffer(index["size"], dtype=np.int64)[order],
+        filenames=np.array(index["filenames"], dtype=str),
+        details=np.array(index["details"], dtype=str),
+        points=np.array(index["count"])
+    )
+    waypoints = list(named_points)
+    coords = np.array([(p["lat"], p["lon"]) for p in waypoints], dtype=np.float64).reshape(-1, 2)
+    wp_order, wp_levels = str_pack(np.hstack((coords, coords)))
+    data.update({f"wp_level{i}": level for i, level in enumerate(wp_levels)})
+    data.update(
+        wp_names=np.array([waypoints[i]["name"] for i in wp_order], dtype=str),
+        wp_filenames=np.array([waypoints[i]["filename"] for i in wp_order], dtype=str)
+    )
+    np.savez(os.path.join(index["dir"], 'tree.npz'), **data)
+    replace_dir(index["dir"], index["path"])
+    print(f"[+] Spatial index: {len(order)} boxes over {index['count']} points, {len(waypoints)} waypoints -> {index['path']}/")
+
+def load_spatial_index(output_dir='.'):
+    index_path = os.path.join(output_dir, SPATIAL_INDEX_DIR)
+    with np.load(os.path.join(index_path, 'tree.npz')) as data:
+        index = {key: data[key] for key in data.files}
+    for prefix in ('level', 'wp_level'):
+        index[prefix + 's'] = [index.pop(f"{prefix}{i}") for i in range(len(index)) if f"{prefix}{i}" in index]
+    # only the points of the candidate runs are read from disk
+    count = int(index["points"])
+    index["coords"] = (np.memmap(os.path.join(index_path, 'points.f8'), dtype=np.float64, mode='r', shape=(count, 2))
+                       if count else np.zeros((0, 2)))
+    return index
+
+def chunk_lines(index, chunks):
+    # the lines of the given runs as end point arrays, plus the track of every line;
+    # a run of a single point becomes a line of length zero
+    sizes = index["size"][chunks]
+    counts = np.maximum(sizes - 1, 1)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    first = np.repeat(index["start"][chunks], counts) + offsets
+    second = first + (np.repeat(sizes, counts) > 1)
+    return index["coords"][first], index["coords"][second], np.repeat(index["track"][chunks], counts)
+
+def local_xy(points, lat, lon):
+    # metres east and north of (lat, lon), an equirectangular projection that is
+    # accurate for the short distances of a nearby query
+    scale = math.radians(1) * EARTH_RADIUS_M
+    return np.column_stack(((points[:, 1] - lon) * scale * math.cos(math.radians(lat)),
+                            (points[:, 0] - lat) * scale))
+
+def line_distances(a, b, lat, lon):
+    pa, pb = local_xy(a, lat, lon), local_xy(b, lat, lon)
+    ab = pb - pa
+    length2 = np.einsum('ij,ij->i', ab, ab)
+    t = np.clip(-np.einsum('ij,ij->i', pa, ab) / np.where(length2 > 0, length2, 1.0), 0.0, 1.0)
+    return np.hypot(*(pa + t[:, None] * ab).T)
+
+def lines_in_box(a, b, box):
+    # Liang-Barsky: a line meets the box if its parameter ranges inside both slabs overlap
+    t0, t1 = np.zeros(len(a)), np.ones(len(a))
+    for axis, lo, hi in ((0, box[0], box[2]), (1, box[1], box[3])):
+        delta = b[:, axis] - a[:, axis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ta, tb = (lo - a[:, axis]) / delta, (hi - a[:, axis]) / delta
+        inside = (a[:, axis] >= lo) & (a[:, axis] <= hi)
+        parallel = delta == 0
+        t0 = np.maximum(t0, np.where(parallel, np.where(inside, 0.0, np.inf), np.minimum(ta, tb)))
+        t1 = np.minimum(t1, np.where(parallel, np.where(inside, 1.0, -np.inf), np.maximum(ta, tb)))
+    return t0 <= t1
+
+def query_waypoints(index, box):
+    found = rtree_search(index["wp_levels"], box)
+    coords = index["wp_levels"][0][found, :2]
+    return [{"name": str(index["wp_names"][i]), "filename": str(index["wp_filenames"][i]), "lat": lat, "lon": lon}
+            for i, (lat, lon) in zip(found.tolist(), coords.tolist())]
+
+def query_bbox(index, box):
+    a, b, tracks = chunk_lines(index, rtree_search(index["levels"], box))
+    hits = np.unique(tracks[lines_in_box(a, b, box)])
+    return {
+        "tracks": [{"filename": str(index["filenames"][i]), "detail": str(index["details"][i])} for i in hits.tolist()],
+        "waypoints": query_waypoints(index, box)
+    }
+
+def query_nearby(index, lat, lon, radius):
+    dlat = math.degrees(radius / EARTH_RADIUS_M)
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    box = (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+    a, b, tracks = chunk_lines(index, rtree_search(index["levels"], box))
+    nearest = np.full(len(index["filenames"]), np.inf)
+    np.minimum.at(nearest, tracks, line_distances(a, b, lat, lon))
+    hits = np.flatnonzero(nearest <= radius)
+    waypoints = query_waypoints(index, box)
+    if waypoints:
+        distances = np.hypot(*local_xy(np.array([(p["lat"], p["lon"]) for p in waypoints]), lat, lon).T)
+        waypoints = [dict(p, distance_m=round(d, 1)) for p, d in zip(waypoints, distances.tolist()) if d <= radius]
+    return {
+        "tracks": sorted(({"filename": str(index["filenames"][i]), "detail": str(index["details"][i]),
+                           "distance_m": round(float(nearest[i]), 1)} for i in hits.tolist()),
+                         key=lambda t: t["distance_m"]),
+        "waypoints": sorted(waypoints, key=lambda p: p["distance_m"])
     }
-    with gzip.open("geo_data.json.gz", "wt", encoding="utf-8") as gz:
-        json.dump(geo_data, gz)
-    print("[+] geo_data.json and geo_data.json.gz saved")
 
-def generate_hybridmap_html():
-    geo_data_mtime = int(os.path.getmtime('geo_data.json.gz'))
-    deepstate_mtime = int(os.path.getmtime('deepstate.geojson'))
+def run_query(args):
+    start = time.perf_counter()
+    try:
+        index = load_spatial_index(args.output_dir)
+    except FileNotFoundError:
+        print(f"[!] No spatial index in {os.path.join(args.output_dir, SPATIAL_INDEX_DIR)}/, run --geodata first")
+        sys.exit(1)
+    if args.query == 'bbox':
+        result = query_bbox(index, (args.south, args.west, args.north, args.east))
+        where = f"in {args.south:g},{args.west:g} - {args.north:g},{args.east:g}"
+    else:
+        result = query_nearby(index, args.lat, args.lon, args.radius)
+        where = f"within {args.radius:g} m of {args.lat:g},{args.lon:g}"
+    elapsed = (time.perf_counter() - start) * 1000
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"[+] {len(result['tracks'])} tracks and {len(result['waypoints'])} waypoints {where} ({elapsed:.1f} ms)")
+    for t in result["tracks"]:
+        distance = f"{t['distance_m']:8.0f} m  " if "distance_m" in t else "    "
+        print(f"    {distance}{t['filename']}")
+    for p in result["waypoints"]:
+        distance = f"{p['distance_m']:8.0f} m  " if "distance_m" in p else "    "
+        print(f"    {distance}{p['name']} ({p['filename']})")
+
+def write_track_detail(track, path, encoding='json', gzip_level=GZIP_LEVEL):
+    # full geometry of a track, fetched by the page only when the track is selected
+    write_geodata(path, {"tracks": [{
+        "filename": track.filename,
+        "stats": track.stats,
+        "segments": track.segments,
+        "dist": dist_steps(track.dist)
+    }]}, encoding, gzip_level)
+    return os.path.getsize(path)
+
+def read_heat_spool(spool):
+    spool.seek(0)
+    while True:
+        chunk = spool.read(HEAT_SPOOL_CHUNK * 16)
+        if not chunk:
+            break
+        yield np.frombuffer(chunk, dtype=np.float64).reshape(-1, 2)
+
+def read_named_spool(spool):
+    spool.seek(0)
+    for line in spool:
+        yield json.loads(line)
+
+def array_chunks(values):
+    for i in range(0, len(values), HEAT_SPOOL_CHUNK):
+        yield values[i:i + HEAT_SPOOL_CHUNK]
+
+def write_json_chunks(gz, chunks):
+    # one JSON array from lists written one after the other
+    gz.write('[')
+    first = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if not first:
+            gz.write(', ')
+        gz.write(json.dumps(chunk)[1:-1])
+        first = False
+    gz.write(']')
+
+def write_heat_points(gz, chunks, encoding='json'):
+    if encoding == 'json':
+        write_json_chunks(gz, (chunk.tolist() for chunk in chunks))
+        return
+    # one polyline for all points, the delta chain carries over from chunk to chunk
+    gz.write('"')
+    prev = np.zeros((1, 2), dtype=np.int64)
+    for chunk in chunks:
+        quantized = np.round(chunk * 10 ** COORD_PRECISION).astype(np.int64)
+        gz.write(json.dumps(encode_varints(np.diff(quantized, axis=0, prepend=prev).ravel()))[1:-1])
+        prev = quantized[-1:]
+    gz.write('"')
+
+def write_heat_level(gz, zoom, cells, weights, encoding='json'):
+    gz.write(f'{{"zoom": {zoom}, "cells": ')
+    if encoding == 'json':
+        write_json_chunks(gz, (heat_grid_cells(c, w) for c, w in zip(array_chunks(cells), array_chunks(weights))))
+    else:
+        write_heat_points(gz, array_chunks(cells), encoding)
+        gz.write(', "weights": ')
+        write_json_chunks(gz, (w.tolist() for w in array_chunks(weights)))
+    gz.write('}')
+
+def save_geodata(items, config=None):
+    # the page's sink: every track is written out as it arrives and then dropped; heat and
+    # waypoints are spooled to temporary files and appended after the tracks, so memory
+    # is bounded by the largest single file and not by the whole archive
+    config = config or Config()
+    # the items are pulled from in here, so parsing is timed along with the writing
+    with recording(config.stats):
+        return _save_geodata(items, config)
+
+def _save_geodata(items, config):
+    lod, tiles, encoding, gzip_level, output_dir = config.lod, config.tiles, config.encoding, config.gzip_level, config.output_dir
+    heat_grid, heat_cap = config.heat_grid, config.heat_cap
+    # the size a non-JSON encoding saves costs a second serialization, so it is only reported with --profile
+    compare = encoding != 'json' and config.profile
+    geodata_path = os.path.join(output_dir, OUTPUT_GEODATA)
+    print(f"[*] Saving geodata to {geodata_path}...")
+    had_tiles = manifest_has_tiles(output_dir)
+    # every output is written beside the served one and swapped in when complete; the details
+    # are named after their content and go straight into place, the last build's stay
+    details_path = os.path.join(output_dir, TRACK_DETAILS_DIR)
+    os.makedirs(details_path, exist_ok=True)
+    details = []
+    totals = {"tracks": 0, "points": 0, "raw_points": 0, "named_points": 0}
+    details_size = 0
+    levels = open_lod_levels(encoding, gzip_level, output_dir) if lod else None
+    track_tiles = [{} for _ in LOD_ZOOM_BANDS] if tiles else None
+    heat_cells = {zoom: ([], []) for zoom in HEAT_GRID_ZOOMS} if heat_grid else None
+    spatial_index = open_spatial_index(output_dir)
+    with tempfile.TemporaryFile() as heat_spool, tempfile.TemporaryFile('w+', encoding='utf-8') as named_spool:
+        gz = open_geodata_stream(geodata_path, encoding, gzip_level)
+        streams = [(gz, encoding, 'serialize')]
+        if compare:
+            # the same data as plain JSON, gzipped only to report the size it would have had;
+            # untimed gzip, so all of it is counted under json_size and not in gzip/serialize
+            json_size = ByteCounter()
+            streams.append((io.TextIOWrapper(gzip.GzipFile(None, 'wb', compresslevel=gzip_level, fileobj=json_size, mtime=0), encoding='utf-8'), 'json', 'json_size'))
+            streams[-1][0].write('{')
+        def write_all(text):
+            for stream, _, stage in streams:
+                with timed(stage):
+                    stream.write(text)
+        write_all('"tracks": [')
+        for item in items:
+            if isinstance(item, Waypoint):
+                named_spool.write(json.dumps(item._asdict()) + '\n')
+                totals["named_points"] += 1
+                continue
+            track = item
+            with timed('serialize'):
+                # named after the content, so the page may cache a detail file for good
+                detail_path = os.path.join(details_path, 'track.tmp')
+                details_size += write_track_detail(track, detail_path, encoding, gzip_level)
+                digest = file_hash(detail_path, 'sha256')[:HASH_LENGTH]
+                detail = f"{TRACK_DETAILS_DIR}/{digest}.json.gz"
+                os.replace(detail_path, os.path.join(details_path, f"{digest}.json.gz"))
+                details.append(detail)
+                coords = track.coords
+                # a light index, the display geometry lives in the levels or tiles when those are written
+                track_data = {
+                    "filename": track.filename,
+                    "bbox": track_bbox(coords),
+                    "points": len(coords),
+                    "stats": track.stats,
+                    "detail": detail
+                }
+                if not (lod or tiles):
+                    track_data["segments"] = track.segments
+                    track_data["dist"] = dist_steps(track.dist)
+                for stream, stream_encoding, stage in streams:
+                    with timed(stage):
+                        if totals["tracks"]:
+                            stream.write(', ')
+                        stream.write(json.dumps(encode_track(track_data, stream_encoding), default=json_default))
+                if levels:
+                    with timed('lod'):
+                        add_lod_track(levels, track, detail, encoding)
+                if tiles:
+                    with timed('tiles'):
+                        add_track_tiles(track_tiles, track, detail)
+                with timed('index'):
+                    add_index_track(spatial_index, track, detail)
+                if heat_grid:
+                    with timed('heat_grid'):
+                        add_heat_cells(heat_cells, coords, heat_cap)
+                else:
+                    heat_spool.write(coords.tobytes())
+                totals["tracks"] += 1
+                totals["points"] += len(coords)
+                totals["raw_points"] += track.raw_points
+        with timed('serialize'):
+            write_all(']')
+            print(f"[+] {totals['tracks']} track details saved to {details_path}/ ({details_size} bytes)")
+            if levels:
+                close_lod_levels(levels, output_dir)
+            grid = [] if heat_grid and tiles else None
+            if not heat_grid:
+                write_all(', "heat_points": ')
+                for stream, stream_encoding, stage in streams:
+                    with timed(stage):
+                        write_heat_points(stream, read_heat_spool(heat_spool), stream_encoding)
+            else:
+                write_all(', "heat_grid": [')
+                for i, (zoom, cells, weights) in enumerate(build_heat_grid(heat_cells)):
+                    for stream, stream_encoding, stage in streams:
+                        with timed(stage):
+                            if i:
+                                stream.write(', ')
+                            write_heat_level(stream, zoom, cells, weights, stream_encoding)
+                    # the point tiles are cut from the whole grid, otherwise each level is dropped once written
+                    if grid is not None:
+                        grid.append({"zoom": zoom, "cells": heat_grid_cells(cells, weights)})
+                write_all(']')
+            write_all(', "named_points": [')
+            for stream, _, stage in streams:
+                with timed(stage):
+                    write_json_items(stream, read_named_spool(named_spool))
+            write_all(']')
+            with timed('clusters'):
+                clusters = build_point_clusters(read_named_spool(named_spool))
+            write_all(', "point_clusters": ' + json.dumps(clusters))
+            close_geodata_stream(gz, geodata_path)
+            prune_generation('details', details, [f"{TRACK_DETAILS_DIR}/{name}" for name in os.listdir(details_path)], output_dir)
+            if compare:
+                with timed('json_size'):
+                    streams[-1][0].write('}')
+                    streams[-1][0].close()
+            with timed('index'):
+                close_spatial_index(spatial_index, read_named_spool(named_spool))
+            if tiles:
+                with timed('tiles'):
+                    save_tiles(track_tiles, lambda: read_heat_spool(heat_spool), read_named_spool(named_spool), encoding, grid, gzip_level, clusters, output_dir)
+    remove_layout_files(lod, tiles, had_tiles, output_dir)
+    size = os.path.getsize(geodata_path)
+    print(f"[+] {geodata_path} saved ({size} bytes)")
+    if compare:
+        print(f"[+] {geodata_path}: {size} bytes {encoding} vs {json_size.size} bytes json ({size / json_size.size:.1%})")
+    return totals
+
+def deepstate_filename(level):
+    return OUTPUT_DEEPSTATE.replace('.json.gz', f'.lod{level}.json.gz')
+
+def deepstate_levels(lod):
+    if not lod:
+        return [(OUTPUT_DEEPSTATE, 0, LOD_ZOOM_BANDS[-1][1], lod_tolerance(DEEPSTATE_MAX_ZOOM))]
+    return [(deepstate_filename(level), min_zoom, max_zoom, lod_tolerance(min(max_zoom, DEEPSTATE_MAX_ZOOM)))
+            for level, (min_zoom, max_zoom) in enumerate(LOD_ZOOM_BANDS)]
+
+def map_geometry_lines(geometry, line):
+    # line(coords, closed) gives the new coordinates of every line string and polygon ring
+    if not geometry:
+        return geometry
+    kind, coords = geometry.get("type"), geometry.get("coordinates")
+    if kind == 'LineString':
+        return dict(geometry, coordinates=line(coords, False))
+    if kind == 'MultiLineString':
+        return dict(geometry, coordinates=[line(c, False) for c in coords])
+    if kind == 'Polygon':
+        return dict(geometry, coordinates=[line(ring, True) for ring in coords])
+    if kind == 'MultiPolygon':
+        return dict(geometry, coordinates=[[line(ring, True) for ring in polygon] for polygon in coords])
+    if kind == 'GeometryCollection':
+        return dict(geometry, geometries=[map_geometry_lines(g, line) for g in geometry["geometries"]])
+    return geometry
+
+def map_geojson_lines(geojson, line):
+    if geojson.get("type") == 'FeatureCollection':
+        return dict(geojson, features=[map_geojson_lines(feature, line) for feature in geojson["features"]])
+    if geojson.get("type") == 'Feature':
+        return dict(geojson, geometry=map_geometry_lines(geojson.get("geometry"), line))
+    return map_geometry_lines(geojson, line)
+
+def quantize_line(coords, closed):
+    # integer [lon, lat] at DEEPSTATE_PRECISION, repeated points dropped, rings kept open
+    if not len(coords):
+        return np.zeros((0, 2), dtype=np.int64)
+    q = np.round(np.asarray(coords, dtype=np.float64)[:, :2] * 10 ** DEEPSTATE_PRECISION).astype(np.int64)
+    q = q[np.append(True, (q[1:] != q[:-1]).any(axis=1))]
+    if closed and len(q) > 1 and (q[0] == q[-1]).all():
+        q = q[:-1]
+    return q
+
+def vertex_keys(q):
+    return (q[:, 0] + 2 ** 30) * 2 ** 31 + (q[:, 1] + 2 ** 30)
+
+def find_junctions(lines):
+    # as in TopoJSON, a vertex is a junction where lines meet or part: it has different
+    # neighbours in different lines, or ends a line string
+    keys, pairs, ends = [], [], []
+    for q, closed in lines:
+        k = vertex_keys(q)
+        if closed and len(k) >= 3:
+            prev, after = np.roll(k, 1), np.roll(k, -1)
+        else:
+            prev = np.append(-1, k[:-1])
+            after = np.append(k[1:], -1)
+            ends.append(k[[0, -1]] if len(k) else k)
+        keys.append(k)
+        pairs.append(np.column_stack((np.minimum(prev, after), np.maximum(prev, after))))
+    if not keys:
+        return np.zeros(0, dtype=np.int64)
+    occurrences = np.unique(np.column_stack((np.concatenate(keys), np.concatenate(pairs))), axis=0)
+    vertices, counts = np.unique(occurrences[:, 0], return_counts=True)
+    return np.union1d(vertices[counts > 1], np.concatenate(ends) if ends else [])
+
+def line_arcs(q, closed, junctions):
+    # the line split into arcs that run from junction to junction
+    k = vertex_keys(q)
+    cuts = np.flatnonzero(np.isin(k, junctions))
+    if not closed:
+        cuts = np.union1d(cuts, [0, len(q) - 1])
+        return [q[a:b + 1] for a, b in zip(cuts[:-1], cuts[1:])]
+    if not len(cuts):
+        # a ring that touches nothing is cut at its lowest vertex and the vertex furthest from
+        # it, so the same ring in another feature is cut in the same places
+        start = int(k.argmin())
+        q = np.roll(q, -start, axis=0)
+        far = int(((q - q[0]) ** 2).sum(axis=1).argmax())
+        cuts = np.array([0, far]) if far else np.array([0])
+    else:
+        q = np.roll(q, -int(cuts[0]), axis=0)
+        cuts = cuts - cuts[0]
+    q = np.vstack((q, q[:1]))
+    cuts = np.append(cuts, len(q) - 1)
+    return [q[a:b + 1] for a, b in zip(cuts[:-1], cuts[1:])]
+
+def simplify_arc(arc, tolerance, arc_cache):
+    # an arc shared by two polygons is simplified once, in one direction, so both keep the same border
+    if len(arc) < 3:
+        return arc
+    k = vertex_keys(arc)
+    reverse = (k[-1], k[-2]) < (k[0], k[1])
+    canonical = arc[::-1] if reverse else arc
+    key = canonical.tobytes()
+    if key not in arc_cache:
+        arc_cache[key] = douglas_peucker_indices(canonical[:, ::-1] / 10 ** DEEPSTATE_PRECISION, tolerance)
+    simplified = canonical[arc_cache[key]]
+    return simplified[::-1] if reverse else simplified
+
+def simplify_deepstate_line(q, closed, junctions, tolerance, arc_cache):
+    if len(q) < (4 if closed else 3):
+        return np.vstack((q, q[:1])) if closed and len(q) else q
+    arcs = [simplify_arc(arc, tolerance, arc_cache) for arc in line_arcs(q, closed, junctions)]
+    line = np.vstack([arc[:-1] for arc in arcs] + [arcs[-1][-1:]])
+    if closed and len(line) < 4:
+        # a ring never collapses, tiny ones keep their quantized shape
+        return np.vstack((q, q[:1]))
+    return line
+
+def encode_deepstate_line(q, encoding):
+    if encoding == 'json':
+        return np.round(q / 10 ** DEEPSTATE_PRECISION, DEEPSTATE_PRECISION).tolist()
+    return encode_varints(np.diff(q, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel())
+
+def prepare_deepstate(encoding='json', lod=False, gzip_level=GZIP_LEVEL, source_path=DEEPSTATE_GEOJSON, output_dir='.', cache_dir=CACHE_DIR):
+    # the overlay is served as a quantized, topology-preserving simplified and gzipped copy
+    # of deepstate.geojson; nothing is redone while the source and the options are the same
+    if not os.path.exists(source_path):
+        print(f"[!] {source_path} not found, the DeepState layer stays empty")
+        return
+    settings = {"version": DEEPSTATE_VERSION, "precision": DEEPSTATE_PRECISION, "encoding": encoding,
+                "lod": lod, "gzip_level": gzip_level}
+    levels = [(os.path.join(output_dir, name), *zooms) for name, *zooms in deepstate_levels(lod)]
+    source = os.stat(source_path)
+    # without a cache_dir the overlay is always rebuilt
+    stamp_path = os.path.join(cache_dir, DEEPSTATE_STAMP) if cache_dir else None
+    try:
+        with open(stamp_path, 'r') as f:
+            stamp = json.load(f)
+    except (OSError, TypeError, ValueError):
+        stamp = {}
+    sha256 = None
+    if stamp.get("settings") == settings and all(os.path.exists(path) for path, *_ in levels):
+        if stamp.get("mtime") == source.st_mtime and stamp.get("size") == source.st_size:
+            print(f"[+] {source_path} unchanged, overlay kept")
+            return
+        sha256 = file_hash(source_path, 'sha256')
+        if stamp.get("sha256") == sha256:
+            print(f"[+] {source_path} touched but unchanged, overlay kept")
+            write_json_file(stamp_path, dict(stamp, mtime=source.st_mtime, size=source.st_size))
+            return
+    print(f"[*] Preparing the DeepState overlay from {source_path}...")
+    with open(source_path, 'r', encoding='utf-8') as f:
+        geojson = json.load(f)
+    lines = []
+    def collect(coords, closed):
+        lines.append((quantize_line(coords, closed), closed))
+        return len(lines) - 1
+    template = map_geojson_lines(geojson, collect)
+    junctions = find_junctions(lines)
+    for path, min_zoom, max_zoom, tolerance in levels:
+        arc_cache = {}
+        simplified = [simplify_deepstate_line(q, closed, junctions, tolerance, arc_cache) for q, closed in lines]
+        data = map_geojson_lines(template, lambda i, closed: encode_deepstate_line(simplified[i], encoding))
+        if encoding != 'json':
+            data["encoding"] = f"polyline{DEEPSTATE_PRECISION}"
+        write_geodata(path + '.tmp', data, 'json', gzip_level)
+        os.replace(path + '.tmp', path)
+        print(f"[+] DeepState z{min_zoom}-{max_zoom}: {sum(len(q) for q in simplified)} of "
+              f"{sum(len(q) + (closed and len(q) > 0) for q, closed in lines)} vertices, {path} ({os.path.getsize(path)} bytes)")
+    # files of the other layout would be served stale
+    if lod:
+        single_path = os.path.join(output_dir, OUTPUT_DEEPSTATE)
+        stale = [single_path] + hashed_files(single_path)
+    else:
+        lod_pattern = os.path.join(output_dir, deepstate_filename('*'))
+        stale = glob.glob(lod_pattern) + glob.glob(lod_pattern[:-len('gz')] + 'br')
+    for path in stale:
+        if os.path.exists(path):
+            os.remove(path)
+    if stamp_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_json_file(stamp_path, {"settings": settings, "mtime": source.st_mtime, "size": source.st_size,
+                                     "sha256": sha256 or file_hash(source_path, 'sha256')})
+
+def generate_hybridmap_html(output_dir='.'):
+    # every file the page fetches is referred to by its content-hashed name, relative to output_dir
+    geo_data_url = publish_file(OUTPUT_GEODATA, output_dir)
+    deepstate = [{"url": publish_file(name, output_dir), "minZoom": min_zoom, "maxZoom": max_zoom}
+                 for lod in (True, False) for name, min_zoom, max_zoom, _ in deepstate_levels(lod)
+                 if os.path.exists(os.path.join(output_dir, name))]
+    manifest = None
+    manifest_path = os.path.join(output_dir, OUTPUT_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        for level in manifest.get("lod", []):
+            level["url"] = publish_file(level["url"], output_dir)
+    published = [geo_data_url] + [level["url"] for level in deepstate + (manifest or {}).get("lod", [])]
+    prune_generation('page', published, [os.path.basename(path) for path in glob.glob(
+        os.path.join(output_dir, '*.' + '[0-9a-f]' * HASH_LENGTH + '.json.*'))], output_dir)
     html = """<!DOCTYPE html>
 <html>
 <head>
@@ -174,6 +2079,22 @@ def generate_hybridmap_html():
             height: 80px;
             animation: spin 1s linear infinite;
         }
+        .poi-cluster div {
+            width: 100%;
+            height: 100%;
+            border-radius: 50%;
+            border: 3px solid rgba(255,255,255,0.8);
+            box-sizing: border-box;
+            display: flex;
+            justify-content: center;
+            align-items: center;
+            font: bold 12px sans-serif;
+            color: #fff;
+        }
+        .poi-cluster-green div { background: rgba(42,173,39,0.85); }
+        .poi-cluster-red div { background: rgba(203,43,62,0.85); }
+        .poi-cluster-blue div { background: rgba(42,129,203,0.85); }
+        .poi-cluster-yellow div { background: rgba(203,194,36,0.9); }
         @keyframes spin {
             0%   { transform: rotate(0deg); }
             100% { transform: rotate(360deg); }
@@ -256,6 +2177,7 @@ var yellowIcon = L.icon({iconUrl:'https://raw.githubusercontent.com/pointhi/leaf
 var redIcon = L.icon({iconUrl:'https://raw.githubusercontent.com/pointhi/leaflet-color-markers/master/img/marker-icon-2x-red.png', iconSize:[25,41], iconAnchor:[12,41], popupAnchor:[1,-34], shadowUrl:'https://unpkg.com/leaflet@1.9.4/dist/images/marker-shadow.png'});
 var tracksLayer = L.layerGroup();
 var heatLayerGroup = L.layerGroup();
+var pointCategories = """ + json.dumps(POINT_CATEGORIES) + """;
 var todoMarkersLayer = L.layerGroup();
 var otherMarkersLayer = L.layerGroup();
 var dsLayer = L.layerGroup();
@@ -287,16 +2209,35 @@ function computeCumulativeDistances(coords) {
   }
   return dists;
 }
+function indexForDistance(dist) {
+  // binary search for the point closest to a distance along the track
+  var lo = 0, hi = cumulativeDistances.length - 1;
+  while (lo < hi) {
+    var mid = (lo + hi) >> 1;
+    if (cumulativeDistances[mid] < dist) lo = mid + 1; else hi = mid;
+  }
+  if (lo > 0 && dist - cumulativeDistances[lo-1] < cumulativeDistances[lo] - dist) lo--;
+  return lo;
+}
+function formatTrackStats(stats) {
+  var text = " | +" + stats.gain_m + " m / -" + stats.loss_m + " m";
+  if (stats.duration_s) {
+    var minutes = Math.round(stats.duration_s / 60);
+    text += " | " + Math.floor(minutes / 60) + ":" + String(minutes % 60).padStart(2, '0') + " h";
+  }
+  return text;
+}
 var cumulativeDistances = null;
-function showProgressbar(coords) {
+function showProgressbar(coords, dists, stats) {
   selectedTrackCoords = coords;
-  cumulativeDistances = computeCumulativeDistances(coords);
+  cumulativeDistances = dists || computeCumulativeDistances(coords);
   trackProgressbarContainer.style.display = 'block';
   trackProgressbarFill.style.width = '0%';
   trackProgressbarHoverdot.style.display = 'none';
   document.getElementById('track-progressbar-distlabel').style.display = 'none';
   var totalDist = cumulativeDistances.length > 0 ? cumulativeDistances[cumulativeDistances.length-1] : 0;
-  document.getElementById('track-progressbar-totaldist').textContent = "File: " + selectedTrackFilename + " | Total distance: " + totalDist.toFixed(2) + " km";
+  document.getElementById('track-progressbar-totaldist').textContent = "File: " + selectedTrackFilename + " | Total distance: " + totalDist.toFixed(2) + " km" +
+    (stats ? formatTrackStats(stats) : "");
   if (movingMarker) {
     map.removeLayer(movingMarker);
     movingMarker = null;
@@ -316,7 +2257,7 @@ function handleProgressTouch(e) {
   var touch = e.touches[0];
   var percent = (touch.clientX - rect.left) / rect.width;
   percent = Math.max(0, Math.min(1, percent));
-  var idx = Math.round(percent * (selectedTrackCoords.length - 1));
+  var idx = indexForDistance(percent * cumulativeDistances[cumulativeDistances.length-1]);
   var latlng = selectedTrackCoords[idx];
   trackProgressbarHoverdot.style.display = 'block';
   trackProgressbarHoverdot.style.left = (percent * 100) + '%';
@@ -339,7 +2280,7 @@ trackProgressbar.addEventListener('mousemove', function(e) {
   var rect = trackProgressbar.getBoundingClientRect();
   var percent = (e.clientX - rect.left) / rect.width;
   percent = Math.max(0, Math.min(1, percent));
-  var idx = Math.round(percent * (selectedTrackCoords.length - 1));
+  var idx = indexForDistance(percent * cumulativeDistances[cumulativeDistances.length-1]);
   var latlng = selectedTrackCoords[idx];
   trackProgressbarHoverdot.style.display = 'block';
   trackProgressbarHoverdot.style.left = (percent * 100) + '%';
@@ -368,74 +2309,418 @@ trackProgressbar.addEventListener('touchend', function() {});
 
 document.getElementById('loader').style.display = 'flex';
 const basePath = new URL('./', window.location.href).href;
-const geoDataUrl = basePath + 'geo_data.json.gz?v=""" + str(geo_data_mtime) + """';
+const geoDataUrl = basePath + '""" + geo_data_url + """';
+const geoManifest = """ + json.dumps(manifest) + """;
 const trackPolylinesByFilename = {};
-fetch(geoDataUrl)
-  .then(response => response.json())
-  .then(data => {
-
-    data.tracks.forEach(track => {
-      trackPolylinesByFilename[track.filename] = [];
-      track.segments.forEach(segment => {
-        var polyline = L.polyline(segment, defaultTrackOpts)
-          .bindPopup("<small style='font-size:10px'>" + track.filename + "</small>");
-        trackPolylinesByFilename[track.filename].push(polyline);
-    
-        polyline.on('click', function(e) {
-          Object.values(trackPolylinesByFilename).forEach(polylines => {
-            polylines.forEach(pl => {
-              pl.setStyle(defaultTrackOpts);
-              pl.bringToBack();
-            });
-          });
-          trackPolylinesByFilename[track.filename].forEach(pl => {
-            pl.setStyle(selectedTrackOpts);
-            pl.bringToFront();
+const trackDetailByFilename = {};
+const trackIndexByFilename = {};
+function drawTracks(tracks) {
+  tracksLayer.clearLayers();
+  Object.keys(trackPolylinesByFilename).forEach(filename => delete trackPolylinesByFilename[filename]);
+  tracks.forEach(track => {
+    trackPolylinesByFilename[track.filename] = [];
+    if (track.detail) trackDetailByFilename[track.filename] = track.detail;
+    var trackOpts = track.filename === selectedTrackFilename ? selectedTrackOpts : defaultTrackOpts;
+    track.segments.forEach(segment => {
+      var polyline = L.polyline(segment, trackOpts)
+        .bindPopup("<small style='font-size:10px'>" + track.filename + "</small>");
+      trackPolylinesByFilename[track.filename].push(polyline);
+
+      polyline.on('click', function(e) {
+        Object.values(trackPolylinesByFilename).forEach(polylines => {
+          polylines.forEach(pl => {
+            pl.setStyle(defaultTrackOpts);
+            pl.bringToBack();
           });
-    
-          polyline.openPopup(e.latlng);
-    
-          selectedTrackFilename = track.filename;
-          selectedTrackCoords = track.coords;
-          showProgressbar(track.coords);
-    
-          L.DomEvent.stopPropagation(e);
+        });
+        trackPolylinesByFilename[track.filename].forEach(pl => {
+          pl.setStyle(selectedTrackOpts);
+          pl.bringToFront();
         });
 
-    tracksLayer.addLayer(polyline);
-  });
-});
-    L.heatLayer(data.heat_points, { radius: 12, blur: 15, maxZoom: 17 }).addTo(heatLayerGroup);
-    data.named_points.forEach(pt => {
-      var iconVar = pt.filename.includes("TODO_MAIN") ? greenIcon :
-                    pt.filename.includes("WP_WAR_RB") ? redIcon :
-                    pt.filename.includes("WP_") ? blueIcon : yellowIcon;
-      var marker = L.marker([pt.lat, pt.lon], {icon: iconVar})
-        .bindPopup(
-          "<b>" + pt.name + "</b><br>" +
-          "<small>" + pt.lat.toFixed(6) + ", " + pt.lon.toFixed(6) + "<br>" +
-          pt.filename + "</small>"
-        );
-      marker.on('mouseover', function(e) {
-        marker.openPopup();
+        polyline.openPopup(e.latlng);
+
+        selectedTrackFilename = track.filename;
+        loadTrackDetail(track.filename).then(detail => {
+          if (detail && selectedTrackFilename === track.filename) {
+            showProgressbar([].concat(...detail.segments), detail.dist, detail.stats);
+          }
+        });
+
+        L.DomEvent.stopPropagation(e);
       });
-      marker.on('mouseout', function(e) {
-        marker.closePopup();
+
+      tracksLayer.addLayer(polyline);
+    });
+  });
+}
+function decodePolyline(str, precision) {
+  var factor = Math.pow(10, precision);
+  var points = [];
+  var lat = 0, lon = 0, i = 0;
+  while (i < str.length) {
+    var shift = 0, result = 0, b;
+    do {
+      b = str.charCodeAt(i++) - 63;
+      result |= (b & 0x1f) << shift;
+      shift += 5;
+    } while (b >= 0x20);
+    lat += (result & 1) ? ~(result >> 1) : (result >> 1);
+    shift = 0;
+    result = 0;
+    do {
+      b = str.charCodeAt(i++) - 63;
+      result |= (b & 0x1f) << shift;
+      shift += 5;
+    } while (b >= 0x20);
+    lon += (result & 1) ? ~(result >> 1) : (result >> 1);
+    points.push([lat / factor, lon / factor]);
+  }
+  return points;
+}
+function decodeVarints(str) {
+  var values = [];
+  var i = 0;
+  while (i < str.length) {
+    var shift = 0, result = 0, b;
+    do {
+      b = str.charCodeAt(i++) - 63;
+      result |= (b & 0x1f) << shift;
+      shift += 5;
+    } while (b >= 0x20);
+    values.push((result & 1) ? ~(result >> 1) : (result >> 1));
+  }
+  return values;
+}
+// compact GeoJSON keeps every line string and ring as one polyline string
+function decodeCoordinates(coords, precision) {
+  if (typeof coords === 'string') return decodePolyline(coords, precision);
+  return Array.isArray(coords) ? coords.map(c => decodeCoordinates(c, precision)) : coords;
+}
+function decodeGeometry(geometry, precision) {
+  if (geometry.geometries) geometry.geometries = geometry.geometries.map(g => decodeGeometry(g, precision));
+  if (geometry.coordinates) geometry.coordinates = decodeCoordinates(geometry.coordinates, precision);
+  return geometry;
+}
+function decodeGeoData(data) {
+  if (!data.encoding) return data;
+  var precision = parseInt(data.encoding.replace('polyline', ''));
+  (data.tracks || []).forEach(track => {
+    if (track.segments) track.segments = track.segments.map(segment => decodePolyline(segment, precision));
+    if (track.coords) track.coords = decodePolyline(track.coords, precision);
+    if (track.dist) track.dist = decodeVarints(track.dist);
+  });
+  if (data.heat_points) data.heat_points = decodePolyline(data.heat_points, precision);
+  (data.features || []).forEach(feature => {
+    if (feature.geometry) feature.geometry = decodeGeometry(feature.geometry, precision);
+  });
+  (data.heat_grid || []).forEach(level => {
+    level.cells = decodePolyline(level.cells, precision).map((p, i) => [p[0], p[1], level.weights[i]]);
+    delete level.weights;
+  });
+  return data;
+}
+function fetchGeoData(url) {
+  return fetch(url)
+    .then(response => response.text())
+    .then(text => {
+      var started = performance.now();
+      var data = decodeGeoData(JSON.parse(text));
+      console.info('[gpxmap] ' + url.split('?')[0] + ' (' + (data.encoding || 'json') + ', ' + text.length +
+                   ' chars) decoded in ' + (performance.now() - started).toFixed(1) + ' ms');
+      return data;
+    });
+}
+var geoDataRequest = null;
+function loadGeoData() {
+  if (!geoDataRequest) {
+    geoDataRequest = fetchGeoData(geoDataUrl)
+      .then(data => {
+        data.tracks.forEach(track => {
+          trackDetailByFilename[track.filename] = track.detail;
+          if (track.segments) trackIndexByFilename[track.filename] = track;
+        });
+        return data;
       });
-      if (pt.filename.includes("TODO")) {
-        marker.addTo(todoMarkersLayer);
-      } else {
-        marker.addTo(otherMarkersLayer);
+  }
+  return geoDataRequest;
+}
+// full coords are only built for the selected track, from the index when it carries
+// the full geometry and from the track's detail file otherwise
+function cumulativeKm(steps) {
+  var dists = new Float64Array(steps.length);
+  var total = 0;
+  for (var i = 0; i < steps.length; ++i) {
+    total += steps[i];
+    dists[i] = total / 1000;
+  }
+  return dists;
+}
+function loadTrackDetail(filename) {
+  var request;
+  if (trackIndexByFilename[filename]) {
+    request = Promise.resolve(trackIndexByFilename[filename]);
+  } else if (trackDetailByFilename[filename]) {
+    request = fetchGeoData(basePath + trackDetailByFilename[filename])
+      .then(data => data.tracks[0]);
+  } else {
+    return Promise.resolve(null);
+  }
+  return request.then(track => ({
+    segments: track.segments,
+    dist: track.dist ? cumulativeKm(track.dist) : null,
+    stats: track.stats
+  }));
+}
+var heatLayer = null;
+function drawHeatPoints(points) {
+  if (heatLayer) {
+    heatLayer.setLatLngs(points);
+  } else {
+    heatLayer = L.heatLayer(points, { radius: 12, blur: 15, maxZoom: 17 }).addTo(heatLayerGroup);
+  }
+}
+// a pre-aggregated heat grid holds [lat, lon, count] cells per zoom, the finest
+// grid at or below the current zoom is drawn
+var heatGrids = null;
+function heatGridForZoom(grids, zoom) {
+  var below = grids.filter(level => level.zoom <= zoom);
+  return below.length ? below[below.length - 1] : grids[0];
+}
+function drawHeatGrid() {
+  if (!heatGrids || !heatGrids.length) return;
+  drawHeatPoints(heatGridForZoom(heatGrids, map.getZoom()).cells);
+}
+map.on('zoomend', drawHeatGrid);
+function namedPointMarker(pt) {
+  var iconVar = pt.filename.includes("TODO_MAIN") ? greenIcon :
+                pt.filename.includes("WP_WAR_RB") ? redIcon :
+                pt.filename.includes("WP_") ? blueIcon : yellowIcon;
+  var marker = L.marker([pt.lat, pt.lon], {icon: iconVar})
+    .bindPopup(
+      "<b>" + pt.name + "</b><br>" +
+      "<small>" + pt.lat.toFixed(6) + ", " + pt.lon.toFixed(6) + "<br>" +
+      pt.filename + "</small>"
+    );
+  marker.on('mouseover', function(e) {
+    marker.openPopup();
+  });
+  marker.on('mouseout', function(e) {
+    marker.closePopup();
+  });
+  if (pt.filename.includes("TODO")) {
+    marker.addTo(todoMarkersLayer);
+  } else {
+    marker.addTo(otherMarkersLayer);
+  }
+}
+function clusterMarker(cluster, zoom) {
+  var category = pointCategories[cluster[3]];
+  var size = cluster[2] < 10 ? 30 : cluster[2] < 100 ? 36 : 44;
+  var marker = L.marker([cluster[0], cluster[1]], {
+    icon: L.divIcon({
+      html: '<div><span>' + cluster[2] + '</span></div>',
+      className: 'poi-cluster poi-cluster-' + category[1],
+      iconSize: [size, size]
+    })
+  });
+  marker.on('click', function(e) {
+    map.setView([cluster[0], cluster[1]], Math.min(zoom + 2, 18));
+  });
+  marker.addTo(category[0] === 'todo' ? todoMarkersLayer : otherMarkersLayer);
+}
+// waypoints are clustered per zoom at build time; only the clusters and single points of
+// the current zoom inside the (padded) viewport get a marker
+var namedPoints = [];
+var pointClusters = [];
+function drawNamedPoints() {
+  todoMarkersLayer.clearLayers();
+  otherMarkersLayer.clearLayers();
+  var zoom = map.getZoom();
+  var bounds = map.getBounds();
+  var padLat = (bounds.getNorth() - bounds.getSouth()) / 4;
+  var padLon = (bounds.getEast() - bounds.getWest()) / 4;
+  function visible(lat, lon) {
+    return lat >= bounds.getSouth() - padLat && lat <= bounds.getNorth() + padLat &&
+           lon >= bounds.getWest() - padLon && lon <= bounds.getEast() + padLon;
+  }
+  var below = pointClusters.filter(level => level.zoom <= zoom);
+  var level = below.length && zoom <= pointClusters[pointClusters.length - 1].zoom ? below[below.length - 1] : null;
+  var points = level ? level.points : namedPoints;
+  points.forEach(pt => {
+    if (visible(pt.lat, pt.lon)) namedPointMarker(pt);
+  });
+  if (level) {
+    level.clusters.forEach(cluster => {
+      if (visible(cluster[0], cluster[1])) clusterMarker(cluster, level.zoom);
+    });
+  }
+}
+function setNamedPoints(points, clusters) {
+  namedPoints = points;
+  pointClusters = (clusters || []).map(level => ({
+    zoom: level.zoom,
+    clusters: level.clusters,
+    points: level.points.map(i => points[i])
+  }));
+  drawNamedPoints();
+}
+function levelForZoom(levels, zoom) {
+  return levels.find(level => zoom >= level.minZoom && zoom <= level.maxZoom) || levels[levels.length - 1];
+}
+// with a lod manifest, track geometry comes from the level of detail matching the zoom
+var lodRequests = {};
+var currentLod = null;
+var drawnLod = null;
+function fetchLod(level) {
+  if (!lodRequests[level.url]) {
+    lodRequests[level.url] = fetchGeoData(basePath + level.url);
+  }
+  return lodRequests[level.url];
+}
+function updateLod() {
+  var level = levelForZoom(geoManifest.lod, map.getZoom());
+  if (level === currentLod) return;
+  currentLod = level;
+  // until something is drawn, the small coarse level is shown while the matching one loads
+  var coarse = geoManifest.lod[0];
+  if (!drawnLod && level !== coarse) {
+    fetchLod(coarse).then(data => {
+      if (!drawnLod) {
+        drawnLod = coarse;
+        drawTracks(data.tracks);
       }
     });
+  }
+  fetchLod(level).then(data => {
+    if (currentLod === level) {
+      drawnLod = level;
+      drawTracks(data.tracks);
+    }
   });
-fetch(basePath + 'deepstate.geojson?v=""" + str(deepstate_mtime) + """')
-    .then(res => res.json())
-    .then(ds => {
-      L.geoJson(ds, {
-        style: { color: '#ff0000', weight: 2, fillOpacity: 0.2 }
-      }).addTo(dsLayer);
-    })
+}
+// with a tiles manifest, only the z/x/y tiles covering the viewport are fetched
+const TILE_CACHE_SIZE = 256;
+var tileCache = new Map();
+var tileView = 0;
+function fetchTile(layer, z, x, y) {
+  var key = layer + '/' + z + '/' + x + '/' + y;
+  var request = tileCache.get(key);
+  if (request) {
+    tileCache.delete(key);
+  } else {
+    request = fetchGeoData(basePath + geoManifest.tiles.url + '/' + key + '.json.gz')
+      .catch(() => { tileCache.delete(key); return {}; });
+  }
+  tileCache.set(key, request);
+  if (tileCache.size > TILE_CACHE_SIZE) tileCache.delete(tileCache.keys().next().value);
+  return request;
+}
+function visibleTiles(level) {
+  var bounds = map.getBounds();
+  var n = Math.pow(2, level.z);
+  function tileX(lon) {
+    return Math.max(0, Math.min(n - 1, Math.floor((lon + 180) / 360 * n)));
+  }
+  function tileY(lat) {
+    var rad = Math.max(-85.0511, Math.min(85.0511, lat)) * Math.PI / 180;
+    return Math.max(0, Math.min(n - 1, Math.floor((1 - Math.log(Math.tan(rad) + 1 / Math.cos(rad)) / Math.PI) / 2 * n)));
+  }
+  var tiles = [];
+  for (var x = tileX(bounds.getWest()); x <= tileX(bounds.getEast()); ++x) {
+    for (var y = tileY(bounds.getNorth()); y <= tileY(bounds.getSouth()); ++y) {
+      if (level.tileSet.has(x + '/' + y)) tiles.push([level.z, x, y]);
+    }
+  }
+  return tiles;
+}
+function updateTiles() {
+  var view = ++tileView;
+  var trackLevel = levelForZoom(geoManifest.tiles.tracks, map.getZoom());
+  var trackTiles = visibleTiles(trackLevel).map(t => fetchTile('tracks', t[0], t[1], t[2]));
+  var pointLevel = levelForZoom(geoManifest.tiles.points, map.getZoom());
+  var pointTiles = visibleTiles(pointLevel).map(t => fetchTile('points', t[0], t[1], t[2]));
+  Promise.all([Promise.all(trackTiles), Promise.all(pointTiles)]).then(([trackData, pointData]) => {
+    if (view !== tileView) return;
+    var tracksByFilename = {};
+    trackData.forEach(tile => (tile.tracks || []).forEach(track => {
+      if (!tracksByFilename[track.filename]) {
+        tracksByFilename[track.filename] = {filename: track.filename, detail: track.detail, segments: []};
+      }
+      tracksByFilename[track.filename].segments.push(...track.segments);
+    }));
+    drawTracks(Object.values(tracksByFilename));
+    if (pointData.some(tile => tile.heat_grid)) {
+      heatGrids = pointData.filter(tile => tile.heat_grid)[0].heat_grid.map((level, i) => ({
+        zoom: level.zoom,
+        cells: [].concat(...pointData.map(tile => tile.heat_grid ? tile.heat_grid[i].cells : []))
+      }));
+      drawHeatGrid();
+    } else {
+      drawHeatPoints([].concat(...pointData.map(tile => tile.heat_points || [])));
+    }
+    // the single points of a tile's clusters index that tile's named points
+    var points = [];
+    var clusters = [];
+    pointData.forEach(tile => {
+      (tile.point_clusters || []).forEach((level, i) => {
+        if (!clusters[i]) clusters[i] = {zoom: level.zoom, clusters: [], points: []};
+        clusters[i].clusters.push(...level.clusters);
+        clusters[i].points.push(...level.points.map(j => j + points.length));
+      });
+      points.push(...(tile.named_points || []));
+    });
+    setNamedPoints(points, clusters);
+  });
+}
+if (geoManifest && geoManifest.tiles) {
+  // the tile lists come with the tiles, under the same content-hashed directory
+  fetchGeoData(basePath + geoManifest.tiles.url + '/' + geoManifest.tiles.index).then(index => {
+    ['tracks', 'points'].forEach(layer => geoManifest.tiles[layer].forEach((level, i) => {
+      level.tileSet = new Set(index[layer][i]);
+    }));
+    updateTiles();
+    map.on('moveend', updateTiles);
+  });
+} else {
+  if (geoManifest && geoManifest.lod) {
+    updateLod();
+    map.on('zoomend', updateLod);
+  }
+  loadGeoData().then(data => {
+    if (!geoManifest) drawTracks(data.tracks);
+    if (data.heat_grid) {
+      heatGrids = data.heat_grid;
+      drawHeatGrid();
+    } else {
+      drawHeatPoints(data.heat_points);
+    }
+    setNamedPoints(data.named_points, data.point_clusters);
+  });
+  map.on('moveend', drawNamedPoints);
+}
+// the prepared DeepState overlay, per zoom band with --deepstate-lod
+var deepstateLevels = """ + json.dumps(deepstate) + """;
+var deepstateRequests = {};
+var currentDeepstate = null;
+function updateDeepstate() {
+  if (!deepstateLevels.length) return Promise.resolve();
+  var level = levelForZoom(deepstateLevels, map.getZoom());
+  if (level === currentDeepstate) return Promise.resolve();
+  currentDeepstate = level;
+  if (!deepstateRequests[level.url]) {
+    deepstateRequests[level.url] = fetchGeoData(basePath + level.url);
+  }
+  return deepstateRequests[level.url].then(ds => {
+    if (currentDeepstate !== level) return;
+    dsLayer.clearLayers();
+    L.geoJson(ds, {
+      style: { color: '#ff0000', weight: 2, fillOpacity: 0.2 }
+    }).addTo(dsLayer);
+  });
+}
+map.on('zoomend', updateDeepstate);
+updateDeepstate()
   .finally(() => {
     document.getElementById('loader').style.display = 'none';
   });
@@ -477,7 +2762,8 @@ map.on('moveend zoomend', updateUrl);
 map.on('overlayadd overlayremove', updateUrl);
 map.on('click', function() {
   if (selectedTrackFilename) {
-    trackPolylinesByFilename[selectedTrackFilename].forEach(pl => {
+    // in tiles mode the selected track may have been unloaded with its tiles
+    (trackPolylinesByFilename[selectedTrackFilename] || []).forEach(pl => {
       pl.setStyle(defaultTrackOpts);
       pl.bringToBack();
     });
@@ -505,39 +2791,369 @@ setTimeout(() => {
 </html>"""
     return html
 
-def main(gen_geodata=False, gen_html=False):
-    if gen_geodata:
-        all_tracks, all_points, all_named_points = [], [], []
-        for root, _, files in os.walk(GPX_DIR, followlinks=True):
-            for filename in files:
-                if filename.lower().endswith('.gpx'):
-                    file_path = os.path.join(root, filename)
-                    print(f"[*] Processing {file_path}")
-                    track, points, named_points = parse_gpx_file(file_path)
-                    if track:
-                        all_tracks.append(track)
-                        all_points.extend(points)
-                        all_named_points.extend(named_points)
-        print(f"[+] Total points for heatmap: {len(all_points)}")
-        print(f"[+] Total named waypoints: {len(all_named_points)}")
-        if not all_tracks:
+def profile_report(stats, wall, jobs=1, top=10):
+    failed = [timing for timing in stats.files if timing["error"]]
+    slowest = sorted(stats.files, key=lambda timing: timing["seconds"], reverse=True)[:top]
+    report = {
+        "wall_s": wall,
+        "jobs": jobs,
+        "stages": dict(sorted(stats.stages.items(), key=lambda item: item[1], reverse=True)),
+        "files": {
+            "parsed": len(stats.files),
+            "failed": len(failed),
+            "bytes": sum(timing["bytes"] for timing in stats.files),
+            "points": sum(timing["points"] for timing in stats.files),
+            "parse_s": sum(timing["seconds"] for timing in stats.files)
+        },
+        "slowest": [dict(timing, points_per_s=timing["points"] / timing["seconds"] if timing["seconds"] else 0.0)
+                    for timing in slowest]
+    }
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+    report["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    if jobs > 1:
+        report["peak_rss_workers_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    traced = [timing for timing in stats.files if "peak_mb" in timing]
+    if traced:
+        report["largest"] = sorted(traced, key=lambda timing: timing["peak_mb"], reverse=True)[:top]
+    return report
+
+def print_profile(report):
+    files = report["files"]
+    print(f"[+] Profile: {report['wall_s']:.2f} s wall, {files['parsed']} files parsed "
+          f"({files['bytes'] / 2**20:.1f} MB, {files['points']} points, {files['failed']} failed)")
+    total = sum(report["stages"].values()) or 1.0
+    print(f"    {'stage':<12} {'seconds':>9} {'share':>7}")
+    for stage, seconds in report["stages"].items():
+        print(f"    {stage:<12} {seconds:>9.3f} {seconds / total:>7.1%}")
+    if report["jobs"] > 1:
+        print(f"    (parse stages are summed over {report['jobs']} worker processes)")
+    peak = f"[+] Peak RSS: {report['peak_rss_mb']:.1f} MB"
+    if "peak_rss_workers_mb" in report:
+        peak += f", {report['peak_rss_workers_mb']:.1f} MB in the largest worker"
+    print(peak)
+    if report["slowest"]:
+        print(f"[+] {len(report['slowest'])} slowest files:")
+        for timing in report["slowest"]:
+            print(f"    {timing['seconds']:8.3f} s {timing['bytes'] / 2**20:8.1f} MB {timing['points']:>9} points  {timing['file']}")
+    if "largest" in report:
+        print(f"[+] {len(report['largest'])} files with the largest parse memory:")
+        for timing in report["largest"]:
+            print(f"    {timing['peak_mb']:8.1f} MB peak {timing['bytes'] / 2**20:8.1f} MB {timing['points']:>9} points  {timing['file']}")
+
+def snapshot_tracks(gpx_dir=GPX_DIR):
+    state = {}
+    for file_path in iter_gpx_files(gpx_dir):
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            # removed between the walk and the stat
+            continue
+        state[file_path] = (st.st_size, st.st_mtime_ns)
+    return state
+
+def wait_for_changes(state, interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE, gpx_dir=GPX_DIR):
+    while True:
+        time.sleep(interval)
+        current = snapshot_tracks(gpx_dir)
+        if current != state:
+            break
+    # a sync usually touches many files, wait until it is over
+    settled_at = time.monotonic()
+    while time.monotonic() - settled_at < debounce:
+        time.sleep(min(interval, debounce))
+        latest = snapshot_tracks(gpx_dir)
+        if latest != current:
+            current = latest
+            settled_at = time.monotonic()
+    added = len(current.keys() - state.keys())
+    removed = len(state.keys() - current.keys())
+    changed = sum(1 for path in current.keys() & state.keys() if current[path] != state[path])
+    print(f"[*] {gpx_dir}/ changed: {added} added, {changed} modified, {removed} removed")
+    return current
+
+def watch(config, debounce=WATCH_DEBOUNCE):
+    # the parse cache makes each rebuild reparse only the files that changed
+    gpx_dir = config.tracks_dir
+    if not config.html:
+        print(f"[!] Without --html, {OUTPUT_HYBRIDMAP_HTML} keeps pointing at the files of its last build")
+    state = snapshot_tracks(gpx_dir)
+    build(config)
+    config = replace(config, full=False)
+    print(f"[*] Watching {gpx_dir}/ for changes, Ctrl+C to stop")
+    try:
+        while True:
+            state = wait_for_changes(state, config.watch_interval, debounce, gpx_dir)
+            if config.stats:
+                config.stats.clear()
+            try:
+                build(config)
+            except Exception as e:
+                # the previous outputs are still in place, try again on the next change
+                print(f"[!] Rebuild failed: {e}")
+            print(f"[*] Watching {gpx_dir}/ for changes, Ctrl+C to stop")
+    except KeyboardInterrupt:
+        print("[*] Watch stopped.")
+
+def accepted_encodings(header):
+    # codings of an Accept-Encoding header with a non-zero q value
+    accepted = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+def served_path(root, url_path):
+    # the build directory is served, except for the GPX files, the caches and the spatial index
+    parts = [part for part in unquote(url_path).split('/') if part]
+    if any(part.startswith('.') for part in parts) or (parts and parts[0] in (GPX_DIR, SPATIAL_INDEX_DIR)):
+        return None
+    path = os.path.join(root, *parts) if parts else root
+    if os.path.isdir(path):
+        path = os.path.join(path, OUTPUT_HYBRIDMAP_HTML)
+    return path if os.path.isfile(path) else None
+
+def negotiate(path, accept_encoding):
+    # a .json.gz URL stands for JSON: served brotli or gzip compressed as the client accepts,
+    # and decompressed for a client that takes neither
+    if not path.endswith('.json.gz'):
+        return path, None, mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    accepted = accepted_encodings(accept_encoding)
+    br_path = path[:-len('gz')] + 'br'
+    if ('br' in accepted or '*' in accepted) and os.path.exists(br_path):
+        return br_path, 'br', 'application/json'
+    if 'gzip' in accepted or '*' in accepted:
+        return path, 'gzip', 'application/json'
+    return path, 'identity', 'application/json'
+
+def read_variant(path, coding, etags):
+    # strong ETags are per file and content coding, and only recomputed when the file changes
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        body = f.read()
+    if coding == 'identity':
+        body = gzip.decompress(body)
+    key = (path, coding, st.st_mtime_ns, st.st_size)
+    if key not in etags:
+        etags[key] = '"' + hashlib.sha256(body).hexdigest()[:HASH_LENGTH] + (f'-{coding}' if coding else '') + '"'
+    return body, etags[key]
+
+def http_response(status, reason, headers, body=b''):
+    lines = [f"HTTP/1.1 {status} {reason}"] + [f"{name}: {value}" for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+async def handle_request(method, target, headers, root, etags):
+    url_path = urlsplit(target).path
+    if method not in ('GET', 'HEAD'):
+        return 405, "Method Not Allowed", {"Allow": "GET, HEAD", "Content-Length": "0"}, b''
+    path = served_path(root, url_path)
+    if path is None:
+        return 404, "Not Found", {"Content-Type": "text/plain", "Content-Length": "9"}, b'Not Found' if method == 'GET' else b''
+    path, coding, content_type = negotiate(path, headers.get('accept-encoding', ''))
+    body, etag = await asyncio.to_thread(read_variant, path, coding, etags)
+    response_headers = {
+        "Content-Type": content_type,
+        "ETag": etag,
+        # content-hashed names never change, anything else is revalidated with its ETag
+        "Cache-Control": IMMUTABLE_CACHE if HASHED_NAME.search(url_path) else 'no-cache',
+    }
+    if coding:
+        response_headers["Vary"] = "Accept-Encoding"
+    if coding not in (None, 'identity'):
+        response_headers["Content-Encoding"] = coding
+    if_none_match = headers.get('if-none-match', '')
+    if if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(',')):
+        return 304, "Not Modified", response_headers, b''
+    response_headers["Content-Length"] = str(len(body))
+    return 200, "OK", response_headers, body if method == 'GET' else b''
+
+async def handle_connection(reader, writer, root, etags):
+    try:
+        # keep-alive: requests are answered one after the other until the client closes
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, target, version = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            start = time.perf_counter()
+            status, reason, response_headers, body = await handle_request(method, target, headers, root, etags)
+            keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+            if not keep_alive:
+                response_headers["Connection"] = "close"
+            writer.write(http_response(status, reason, response_headers, body))
+            await writer.drain()
+            coding = response_headers.get("Content-Encoding", "identity")
+            print(f"[*] {method} {target} {status} {coding} {len(body)} bytes {(time.perf_counter() - start) * 1000:.1f} ms")
+            if not keep_alive:
+                break
+    except (ValueError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def run_server(root, host, port):
+    etags = {}
+    server = await asyncio.start_server(partial(handle_connection, root=root, etags=etags), host, port)
+    print(f"[*] Serving {os.path.abspath(root)} on http://{host}:{port}/, Ctrl+C to stop")
+    async with server:
+        await server.serve_forever()
+
+def serve(root='.', host=SERVE_HOST, port=SERVE_PORT):
+    try:
+        asyncio.run(run_server(root, host, port))
+    except KeyboardInterrupt:
+        print("[*] Server stopped.")
+
+def main(config):
+    if config.profile or config.profile_memory:
+        config = replace(config, stats=config.stats or Stats())
+    profiler = None
+    if config.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if config.profile_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        if config.watch:
+            watch(config)
+        else:
+            build(config)
+    finally:
+        wall = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(config.cprofile)
+            print(f"[+] cProfile stats saved to {config.cprofile} (python -m pstats {config.cprofile})")
+        if config.profile_memory:
+            tracemalloc.stop()
+        if config.profile or config.profile_memory:
+            report = profile_report(config.stats, wall, config.jobs, config.profile_top)
+            print_profile(report)
+            profile_path = os.path.join(config.output_dir, OUTPUT_PROFILE)
+            with open(profile_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"[+] Profile report saved to {profile_path}")
+
+def build(config):
+    # the map build: GPX files -> parse -> save_geodata, then the overlay and the page
+    with recording(config.stats):
+        _build(config)
+
+def _build(config):
+    output_dir = config.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    if config.geodata:
+        paths = iter_gpx_files(config.tracks_dir)
+        if config.dedup:
+            paths = dedup_gpx_files(paths)
+        items = iter_gpx(paths, config)
+        if config.dedup:
+            items = dedup_waypoints(dedup_tracks(items))
+        first = next(items, None)
+        if first is None:
             print("[!] No tracks found. Exiting.")
             return
-        save_geodata(all_tracks, all_points, all_named_points)
-    if gen_html:
-        with open(OUTPUT_HYBRIDMAP_HTML, 'w') as f:
-            f.write(generate_hybridmap_html())
-        print(f"[+] Hybrid map saved to {OUTPUT_HYBRIDMAP_HTML}")
+        totals = save_geodata(chain([first], items), config)
+        method = f"Douglas-Peucker {config.simplify:g} m" if config.simplify else f"every {config.point_skip}th point"
+        if totals["raw_points"]:
+            print(f"[+] Simplification ({method}): kept {totals['points']} of {totals['raw_points']} points ({totals['points'] / totals['raw_points']:.1%})")
+        print(f"[+] Total points for heatmap: {totals['points']}")
+        print(f"[+] Total named waypoints: {totals['named_points']}")
+    with timed('deepstate'):
+        prepare_deepstate(config.encoding, config.deepstate_lod, config.gzip_level, config.deepstate, output_dir, config.cache_dir)
+    if config.html:
+        html_path = os.path.join(output_dir, OUTPUT_HYBRIDMAP_HTML)
+        with timed('html'):
+            # generated before the temporary file is opened, so a failure leaves nothing behind
+            html = generate_hybridmap_html(output_dir)
+            with open(html_path + '.tmp', 'w') as f:
+                f.write(html)
+            os.replace(html_path + '.tmp', html_path)
+        print(f"[+] Hybrid map saved to {html_path}")
     else:
         print("[*] HTML generation skipped.")
+    if config.brotli:
+        with timed('brotli'):
+            write_brotli_variants(output_dir)
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="GPX processor script")
     parser.add_argument('--geodata', action='store_true', help='Generate geodata files')
+    parser.add_argument('--tracks-dir', default=GPX_DIR, metavar='DIR', help=f'Directory searched for GPX files (default: {GPX_DIR})')
+    parser.add_argument('--output-dir', default='.', metavar='DIR', help=f'Directory for the page and its data, with the parse cache in DIR/{CACHE_DIR} (default: .)')
+    parser.add_argument('--deepstate', default=DEEPSTATE_GEOJSON, metavar='FILE', help=f'GeoJSON source of the DeepState overlay (default: {DEEPSTATE_GEOJSON})')
     parser.add_argument('--html', action='store_true', help='Generate HTML files')
+    parser.add_argument('--full', action='store_true', help='Ignore the parse cache and reparse every GPX file')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help='Parse GPX files in N worker processes (0 = all cores)')
+    parser.add_argument('--reader', choices=READERS, default='gpxpy', help='GPX reader: gpxpy, or a streaming XML reader that falls back to gpxpy (default: gpxpy)')
+    parser.add_argument('--dedup', action='store_true', help='Skip byte-identical GPX files and drop near-duplicate tracks and repeated waypoints')
+    parser.add_argument('--simplify', type=float, metavar='METRES', help=f'Simplify tracks with Douglas-Peucker at this tolerance instead of keeping every {POINT_SKIP}th point')
+    layout = parser.add_mutually_exclusive_group()
+    layout.add_argument('--lod', action='store_true', help='Also write per-zoom levels of detail for the tracks layer')
+    layout.add_argument('--tiles', action='store_true', help='Also write z/x/y tiles so the map only fetches what is in view')
+    parser.add_argument('--encoding', choices=ENCODINGS, default='json', help='Coordinate encoding: plain JSON arrays, or quantized delta-encoded polyline strings (default: json)')
+    parser.add_argument('--heat-grid', action='store_true', help='Pre-aggregate heat points into weighted per-zoom grid cells')
+    parser.add_argument('--heat-cap', type=int, metavar='N', help='With --heat-grid, limit how much one file adds to a single cell')
+    parser.add_argument('--deepstate-lod', action='store_true', help=f'Write the {DEEPSTATE_GEOJSON} overlay simplified per zoom band instead of as a single file')
+    parser.add_argument('--gzip-level', type=int, choices=range(1, 10), default=GZIP_LEVEL, metavar='1-9', help=f'Compression level of the written .json.gz files (default: {GZIP_LEVEL})')
+    parser.add_argument('--brotli', action='store_true', help='Also write a precompressed .json.br beside every published .json.gz (needs the brotli package)')
+    parser.add_argument('--serve', action='store_true', help='Serve the outputs over HTTP with content negotiation, ETags and immutable caching of content-hashed files')
+    parser.add_argument('--bind', default=SERVE_HOST, metavar='ADDRESS', help=f'Address for --serve (default: {SERVE_HOST})')
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help=f'Port for --serve (default: {SERVE_PORT})')
+    parser.add_argument('--profile', action='store_true', help=f'Print time per pipeline stage and the slowest files, and save them to {OUTPUT_PROFILE}')
+    parser.add_argument('--profile-top', type=int, default=10, metavar='N', help='Number of files listed in the profile (default: 10)')
+    parser.add_argument('--profile-memory', action='store_true', help='Also trace the peak memory of parsing each file with tracemalloc (slow, needs --jobs 1)')
+    parser.add_argument('--cprofile', metavar='FILE', help='Run under cProfile and save the stats to FILE (main process only, use --jobs 1)')
+    parser.add_argument('--watch', action='store_true', help='Keep running and rebuild whenever files in the tracks directory change (needs --geodata)')
+    parser.add_argument('--watch-interval', type=float, default=WATCH_INTERVAL, metavar='SECONDS', help=f'How often --watch looks for changes (default: {WATCH_INTERVAL:g})')
+    commands = parser.add_subparsers(dest='command', metavar='query')
+    query = commands.add_parser('query', help=f'Search the spatial index written by --geodata to {SPATIAL_INDEX_DIR}/')
+    query_types = query.add_subparsers(dest='query', required=True)
+    query_options = argparse.ArgumentParser(add_help=False)
+    query_options.add_argument('--json', action='store_true', help='Print the matches as JSON')
+    bbox = query_types.add_parser('bbox', parents=[query_options], help='Tracks and waypoints inside a bounding box')
+    for name in ('south', 'west', 'north', 'east'):
+        bbox.add_argument(name, type=float)
+    nearby = query_types.add_parser('nearby', parents=[query_options], help='Tracks and waypoints near a point, closest first')
+    nearby.add_argument('lat', type=float)
+    nearby.add_argument('lon', type=float)
+    nearby.add_argument('--radius', type=float, default=500, metavar='METRES', help='Search radius (default: 500)')
     args = parser.parse_args()
-    if not any(vars(args).values()):
+    if args.command == 'query':
+        run_query(args)
+        sys.exit(0)
+    if not (args.geodata or args.html or args.serve):
         parser.print_help()
         sys.exit(0)
-    main(gen_geodata=args.geodata, gen_html=args.html)
+    if args.watch and not args.geodata:
+        parser.error('--watch needs --geodata')
+    if args.heat_cap is not None and not args.heat_grid:
+        parser.error('--heat-cap needs --heat-grid')
+    if args.brotli and brotli is None:
+        parser.error('--brotli needs the brotli package (pip install brotli)')
+    if args.serve and not (args.geodata or args.html):
+        serve(args.output_dir, args.bind, args.port)
+        sys.exit(0)
+    if args.serve and args.watch:
+        # rebuilds are picked up by the running server, the files are swapped in atomically
+        threading.Thread(target=serve, args=(args.output_dir, args.bind, args.port), daemon=True).start()
+    main(Config.from_args(args))
+    if args.serve and not args.watch:
+        serve(args.output_dir, args.bind, args.port)